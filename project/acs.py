@@ -2,8 +2,55 @@ import urllib3
 import requests
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import metrics
+
+#Census API location; may point at a local stand-in server for testing
+BASE_URL = os.environ.get("CENSUS_API_URL", "https://api.census.gov/data")
+DATASET = "/2018/acs/acs5/profile"
+
+#Census API responses are saved in this sqlite3 file, so result pages
+#don't wait on the API. ACS 5-year estimates only change once a year.
+CACHE_DB = os.environ.get("ACS_CACHE", "acs_cache.sqlite3")
+CACHE_TTL = 30 * 24 * 60 * 60
+
+#If true, the Census API is never called: everything is served from the
+#cache (however old), e.g., one seeded with python3 acs.py -prefetch
+OFFLINE = os.environ.get("ACS_OFFLINE", "") == "1"
+
+#In-process copies of cached responses and default() dataframes,
+#as key: (time fetched, value)
+_RESPONSES = {}
+_FRAMES = {}
+
+#Values computed from a dataframe (e.g., percentile ranks), as
+#id(df): (df, {name: value}). Holding on to df keeps its id from
+#being reused; only the most recent MAX_DERIVED dataframes are kept.
+#Reentrant, as some values are built from others (see rank_all).
+_DERIVED = {}
+_DERIVED_LOCK = threading.RLock()
+MAX_DERIVED = 8
+
+#Graphs are rendered once per location and ACS snapshot into this folder
+#(inside static/), keeping the GRAPH_CACHE_SIZE most recently used.
+GRAPH_FOLDER = "graphs"
+GRAPH_CACHE_SIZE = 500
+
+#Histograms on the results page, in 2x2 order: (column, scale, x label)
+GRAPHS = [("Population", 1000, "Population (1000's)"),
+          ("Mean Age", 1, "Mean Age"),
+          ("Med HH Income", 1000, "Median Household Income (1000's)"),
+          ("% HH Kids", 1, "% of Households with Kids")]
 
 STATE_CODES = {
         'AK': 'Alaska',
@@ -77,8 +124,8 @@ def build_query(search_vars, geo, restriction=None):
     '''
 
     key = "0d74ca848dfe8fb825f5c83baee1c0595418bc51"
-    base_url = "https://api.census.gov/data"
-    dataset = "/2018/acs/acs5/profile"
+    base_url = BASE_URL
+    dataset = DATASET
     var_request_start = "?get="
     geo_start = "&for="
     geo_2 = "&in="
@@ -102,16 +149,80 @@ def build_query(search_vars, geo, restriction=None):
     return url
 
 
-def get_request(url):
+def cache_key(url):
     '''
-    Query the census API
+    Returns the part of a query URL that identifies the data (dataset,
+    year, variables and geography), without the API key.
     '''
+    return url.replace(BASE_URL, "").split("&key=")[0]
 
-    r = requests.get(url)
-    return pd.DataFrame(r.json()[1:], columns=r.json()[0])
+
+def fetch_json(url, ttl=None):
+    '''
+    Returns the JSON response for a Census API query, from memory or
+    the cache file when it is younger than ttl seconds, otherwise from
+    the API (saving it to the cache). Falls back to a stale cached
+    response if the API can't be reached.
+
+    Inputs:
+        url (str): query URL from build_query
+        ttl (int): maximum age in seconds of a cached response.
+            If none, uses CACHE_TTL.
+    '''
+
+    key = cache_key(url)
+    ttl = CACHE_TTL if ttl is None else ttl
+    now = time.time()
+
+    if key in _RESPONSES:
+        fetched, rows = _RESPONSES[key]
+        if OFFLINE or now - fetched < ttl:
+            return rows
+
+    conn = sqlite3.connect(CACHE_DB, timeout=30)
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS acs_cache "
+                     "(key PRIMARY KEY, fetched, response);")
+        cached = conn.execute("SELECT fetched, response FROM acs_cache WHERE key = ?;",
+                              (key, )).fetchone()
+        if cached and (OFFLINE or now - cached[0] < ttl):
+            rows = json.loads(cached[1])
+            _RESPONSES[key] = (cached[0], rows)
+            return rows
+        if OFFLINE:
+            raise LookupError("No cached ACS data for " + key + " in " + CACHE_DB +
+                              " and offline mode is on.")
+
+        try:
+            r = requests.get(url)
+            r.raise_for_status()
+            rows = r.json()
+        except (requests.RequestException, ValueError):
+            if cached:
+                rows = json.loads(cached[1])
+                _RESPONSES[key] = (cached[0], rows)
+                return rows
+            raise
+
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO acs_cache VALUES (?, ?, ?);",
+                         (key, now, json.dumps(rows)))
+        _RESPONSES[key] = (now, rows)
+        return rows
+    finally:
+        conn.close()
+
+
+def get_request(url, ttl=None):
+    '''
+    Query the census API (through the cache)
+    '''
+
+    rows = fetch_json(url, ttl)
+    return pd.DataFrame(rows[1:], columns=rows[0])
 
 
-def name_states():
+def name_states(ttl=None):
     '''
     Create a dictionary of state number: state name pairs from ACS data
     '''
@@ -120,20 +231,30 @@ def name_states():
     geo = ("state", "*")
 
     url = build_query(search_vars, geo)
-    r = requests.get(url)
+    rows = fetch_json(url, ttl)
     
-    return {k: v for (v, k) in r.json()[1:]}
+    return {k: v for (v, k) in rows[1:]}
 
 
-def default(geo, rest=None):
+@metrics.timed("acs.default")
+def default(geo, rest=None, ttl=None):
     '''
-    Return a dataframe with the standard characteristics requested for all zips
+    Return a dataframe with the standard characteristics requested for all zips.
+    The dataframe is kept in memory and shared between calls, so don't modify it.
     '''
 
     search_vars = ["DP02_0086E", "DP03_0062E", "DP05_0018E", "DP02_0003PE"]
     
     url = build_query(search_vars, geo, rest)
-    df = get_request(url)
+    key = cache_key(url)
+    ttl = CACHE_TTL if ttl is None else ttl
+    if key in _FRAMES:
+        fetched, df = _FRAMES[key]
+        if OFFLINE or time.time() - fetched < ttl:
+            return df
+
+    fetched = time.time()
+    df = get_request(url, ttl)
     cols = {"DP02_0086E": "Population", "DP03_0062E": "Med HH Income",
             "DP05_0018E": "Mean Age", "DP02_0003PE": "% HH Kids",
             "zip code tabulation area": "Zip Code", "state": "State"}
@@ -142,14 +263,84 @@ def default(geo, rest=None):
     df.set_index(cols[geo[0]], inplace=True)
 
     if df.index.name == "State":
-        df.rename(index=name_states(), inplace=True)
+        df.rename(index=name_states(ttl), inplace=True)
 
     for column in df.columns:
         df[column] = pd.to_numeric(df[column])
 
+    _FRAMES[key] = (fetched, df)
     return df
 
 
+def prefetch():
+    '''
+    Downloads the zip code and state data used by the app into the cache,
+    replacing anything already there, so the app can run offline.
+    '''
+
+    for geo in [("zip code tabulation area", "*"), ("state", "*")]:
+        print("Fetching ACS data by " + geo[0])
+        default(geo, ttl=0)
+    print("Saved to " + CACHE_DB)
+
+
+def derived(df, name, build):
+    '''
+    Returns build(df), computing it only the first time it is asked
+    for with this dataframe. Dataframes returned by default() are
+    shared between calls, so this is computed once per ACS snapshot,
+    even by the app's threads computing stats at the same time.
+    '''
+
+    with _DERIVED_LOCK:
+        entry = _DERIVED.get(id(df))
+        if entry is None or entry[0] is not df:
+            while len(_DERIVED) >= MAX_DERIVED:
+                del _DERIVED[next(iter(_DERIVED))]
+            entry = _DERIVED[id(df)] = (df, {})
+        if name not in entry[1]:
+            entry[1][name] = build(df)
+        return entry[1][name]
+
+
+def percentile_breaks(df):
+    '''
+    Given a dataframe (df), return a dictionary of column: array of the
+    0th to 99th percentile values of that column, from a single sort.
+    '''
+
+    return {col: np.nanpercentile(df[col], np.arange(100)) for col in df.columns}
+
+
+def rank_values(breaks, values):
+    '''
+    Given the percentile breaks of a column and an array of values,
+    return the percentile, 0-99, of each value: one less than the
+    first percentile at or above the value (99 if there is none).
+    '''
+
+    if np.isnan(breaks).all():
+        return np.full(np.shape(values), 99)
+    ranks = np.searchsorted(breaks, values, side="left") - 1
+    return np.where(ranks == len(breaks) - 1, 99, ranks)
+
+
+def rank_all(df):
+    '''
+    Given a dataframe (df), return a dataframe of the same shape with the
+    percentile, 0-99, of every value within its column, in one pass per
+    column. Cached with the dataframe.
+    '''
+
+    def build(df):
+        breaks = derived(df, "percentile_breaks", percentile_breaks)
+        return pd.DataFrame({col: rank_values(breaks[col], df[col].values)
+                             for col in df.columns}, index=df.index)
+
+    return derived(df, "ranks", build)
+
+
+@metrics.timed("acs.find_percentile")
 def find_percentile(df, col, index_val):
     '''
     Given a dataframe (df) and a column (col), determine the percentile, 0-99,
@@ -158,38 +349,158 @@ def find_percentile(df, col, index_val):
 
     i_v = STATE_CODES.get(index_val, index_val)
 
-    benchmark = df[col].loc[i_v]
+    return int(rank_all(df)[col].loc[i_v])
+
+
+def find_percentiles(df, index_val):
+    '''
+    Given a dataframe (df), return a list of [percentile, column] pairs
+    for the location in index_val, one for each column
+    '''
+
+    return [[find_percentile(df, col, index_val), col] for col in df.columns]
+
+
+def snapshot_id(df):
+    '''
+    Return a short id for the contents of a dataframe, so files built
+    from it can tell one ACS snapshot from the next. Cached with the dataframe.
+    '''
+
+    def build(df):
+        hashed = pd.util.hash_pandas_object(df).values.tobytes()
+        return hashlib.sha1(hashed).hexdigest()[:12]
+
+    return derived(df, "snapshot_id", build)
+
+
+def bin_count(values):
+    '''
+    Number of histogram bins for the values: the Freedman-Diaconis
+    rule, capped at 50 (as seaborn's distplot does).
+    '''
+
+    if len(values) < 2:
+        return 1
+    iqr = np.subtract(*np.percentile(values, [75, 25]))
+    width = 2 * iqr / len(values) ** (1 / 3)
+    if width == 0:
+        return min(int(np.sqrt(len(values))), 50)
+    return min(int(np.ceil((values.max() - values.min()) / width)), 50)
+
+
+def histograms(df):
+    '''
+    Given a dataframe (df), return a dictionary of column: (counts, bin
+    edges, scaled values) for each graph in GRAPHS, using only positive
+    values. Cached with the dataframe, so each ACS snapshot is binned once.
+    '''
+
+    def build(df):
+        hists = {}
+        for col, scale, _ in GRAPHS:
+            values = df[df[col] > 0][col] / scale
+            counts, edges = np.histogram(values, bins=bin_count(values.values))
+            hists[col] = (counts, edges, values)
+        return hists
+
+    return derived(df, "histograms", build)
 
-    for i in range(100):
-        per_val = np.nanpercentile(df[col], i)
-        if per_val >= benchmark:
-            return i-1
 
-    return 99
+def graph_data(df, index_val):
+    '''
+    Given a dataframe (df), return the graphs for the location in index_val
+    as a JSON-ready dictionary of column: {label, counts, edges, value}.
+    value is None when the location has no positive value for that column.
+    '''
 
+    hists = histograms(df)
+    data = {}
+    for col, _, label in GRAPHS:
+        counts, edges, values = hists[col]
+        value = values.get(index_val)
+        data[col] = {"label": label, "counts": counts.tolist(), "edges": edges.tolist(),
+                     "value": None if value is None else float(value)}
+    return data
 
+
+@metrics.timed("acs.make_graph")
 def make_graph(df, index_val):
     '''
-    Given a column (variable), create the graph for that column in the df
-    '''
-
-    sns.set_style("ticks")
-
-    pop = df[df["Population"] > 0]["Population"] / 1000
-    age = df[df["Mean Age"] > 0]["Mean Age"]
-    income = df[df["Med HH Income"] > 0]["Med HH Income"] / 1000
-    kids = df[df["% HH Kids"] > 0]["% HH Kids"]
-
-    f, axes = plt.subplots(2, 2, sharey=True, figsize=(8, 8))
-    sns.distplot(pop, kde=False, axlabel="Population (1000's)",
-                 ax=axes[0, 0]).set_yscale("log")
-    sns.distplot(age, kde=False, ax=axes[0, 1]).set_yscale("log")
-    sns.distplot(income, kde=False, axlabel="Median Household Income (1000's)",
-                 ax=axes[1, 0]).set_yscale("log")
-    sns.distplot(kids, kde=False, axlabel="% of Households with Kids",
-                 ax=axes[1, 1]).set_yscale("log")
-    axes[0,0].axvline(x=pop.loc[index_val])
-    axes[0,1].axvline(x=age.loc[index_val])
-    axes[1,0].axvline(x=income.loc[index_val])
-    axes[1,1].axvline(x=kids.loc[index_val])
-    plt.savefig("static/graphs.png")
\ No newline at end of file
+    Given a dataframe (df), create the graphs for the location in index_val
+    and return the file name to use with url_for('static', ...). Each
+    location is drawn once per ACS snapshot, and the file is reused after
+    that. Safe to call from several threads or workers at once.
+    '''
+
+    folder = os.path.join("static", GRAPH_FOLDER)
+    name = snapshot_id(df) + "_" + re.sub(r"\W", "_", str(index_val)) + ".png"
+    path = os.path.join(folder, name)
+
+    if os.path.exists(path):
+        #mark as recently used
+        os.utime(path)
+        return GRAPH_FOLDER + "/" + name
+
+    os.makedirs(folder, exist_ok=True)
+    data = graph_data(df, index_val)
+
+    f = Figure(figsize=(8, 8))
+    FigureCanvasAgg(f)
+    axes = f.subplots(2, 2, sharey=True)
+    for ax, (col, _, _) in zip(axes.flat, GRAPHS):
+        graph = data[col]
+        edges = np.array(graph["edges"])
+        ax.bar(edges[:-1], graph["counts"], width=np.diff(edges), align="edge",
+               alpha=0.4, edgecolor="white")
+        ax.set_yscale("log")
+        ax.set_xlabel(graph["label"])
+        if graph["value"] is not None:
+            ax.axvline(x=graph["value"])
+
+    #write to a temporary file first so no one sees a half-written graph
+    temp, temp_path = tempfile.mkstemp(suffix=".tmp", dir=folder)
+    os.close(temp)
+    f.savefig(temp_path, format="png")
+    os.replace(temp_path, path)
+    evict_graphs(folder)
+
+    return GRAPH_FOLDER + "/" + name
+
+
+def evict_graphs(folder, keep=None):
+    '''
+    Deletes the least recently used graphs in folder beyond the newest keep
+    (default GRAPH_CACHE_SIZE).
+    '''
+
+    keep = GRAPH_CACHE_SIZE if keep is None else keep
+    graphs = []
+    for name in os.listdir(folder):
+        if name.endswith(".png"):
+            try:
+                graphs.append((os.path.getmtime(os.path.join(folder, name)), name))
+            except FileNotFoundError:
+                pass
+    for _, name in sorted(graphs)[:-keep or None]:
+        try:
+            os.remove(os.path.join(folder, name))
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fetches the American Community Survey data used by \
+                                     the app into a local cache. Set ACS_OFFLINE=1 when running the app \
+                                     to serve only from the cache.')
+    parser.add_argument('-prefetch', action='store_true',
+                        help='Download (or refresh) the zip code and state data into the cache.')
+    parser.add_argument('-cache', help='Cache file to use. Default acs_cache.sqlite3 or $ACS_CACHE.')
+    args = parser.parse_args()
+
+    if args.cache:
+        CACHE_DB = args.cache
+    if args.prefetch:
+        prefetch()
+    else:
+        parser.print_help()
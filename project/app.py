@@ -1,8 +1,17 @@
+import collections
+import concurrent.futures
+import datetime
+import re
 import sqlite3
+import threading
+import time
 from flask import Flask
-from flask import render_template, url_for, request, g
+from flask import render_template, url_for, request, g, jsonify, abort
+from flask import Response, json, stream_with_context
 import acs
 import database_functions as df
+import page_cache
+import metrics
 
 
 app = Flask(__name__)
@@ -11,58 +20,247 @@ app = Flask(__name__)
 database_name = input("What is the database file name? e.g., IRS_DATA.sqlite3: ")
 #database_name = "IRS_DATA.sqlite3"
 
+#ACS geography of each kind of location
+ACS_GEOS = {"zip": ("zip code tabulation area", "*"), "state": ("state", "*")}
+
+#Community statistics (ACS data, percentiles and graphs) are computed by
+#this pool, so results pages return without waiting on the Census API
+STATS_WORKERS = 4
+stats_pool = concurrent.futures.ThreadPoolExecutor(STATS_WORKERS)
+
+#Jobs kept per area, as (time started, job), least recently used first,
+#so every page for an area shares one job. A finished job is redone
+#once it is as old as the ACS data it used may be (acs.CACHE_TTL).
+STATS_JOBS_KEPT = 256
+stats_jobs = collections.OrderedDict()
+stats_lock = threading.Lock()
+
+#Pages are cached until the database is rebuilt, or this app restarts
+#(e.g., with new templates)
+STARTED = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+#Results per page of the JSON API, unless ?limit= asks for another
+#number, up to API_MAX_LIMIT
+API_PAGE_SIZE = 100
+API_MAX_LIMIT = 10000
+
+#Most EINs or names one /api/batch request may send
+API_MAX_BATCH = 100000
+
+metrics.setup_log()
+
+
+@app.before_request
+def start_timing():
+    # Times the request and its stages (see metrics.py), profiling it
+    # too with ?profile=1 when PROFILE_DIR is set
+    metrics.start_request()
+    g.profiler = metrics.start_profile() if request.args.get("profile") == "1" else None
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def finish_timing(response):
+    # Records the request's time by endpoint, and logs its stages
+    seconds = time.perf_counter() - g.get("started", time.perf_counter())
+    stages = metrics.finish_request()
+    metrics.observe("request." + (request.endpoint or "unknown"), seconds)
+    fields = {}
+    if g.get("profiler"):
+        fields["profile"] = metrics.stop_profile(g.profiler, request.path)
+        response.headers["X-Profile"] = fields["profile"]
+    metrics.log_event("request", method=request.method, path=request.path, endpoint=request.endpoint,
+                      status=response.status_code, seconds=round(seconds, 6),
+                      stages={stage: round(value, 6) for stage, value in stages.items()}, **fields)
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_page():
+    # Histograms of the time spent in each stage, for Prometheus
+    return Response(metrics.prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+
+@metrics.timed("render_template")
+def render(template_name, **context):
+    return render_template(template_name, **context)
+
+
 @app.route("/", methods=["GET"])
 
 def index():
     user = {'username':'New User'}
-    return render_template('index.html', title='GrantDev', user=user)
+    return render('index.html', title='GrantDev', user=user)
+
+
+def plain_number(value):
+    '''
+    Returns a NumPy number as a plain int or float for JSON, or None
+    if it is missing.
+    '''
+    value = value.item() if hasattr(value, "item") else value
+    return None if value != value else value
+
+
+@metrics.timed("stats.community_stats")
+def community_stats(loc_type, location):
+    '''
+    Runs in stats_pool: collects the ACS data for the location (a zip
+    code or full state name), its percentiles and its graphs. Returns
+    None if the Census has no data for the location.
+    '''
+    acs_data = acs.default(ACS_GEOS[loc_type])
+    if location not in acs_data.index:
+        return None
+    pop, med_income, mean_age, kids = acs_data.loc[location]
+    percents = acs.find_percentiles(acs_data, location)
+    graph = acs.make_graph(acs_data, location)
+    return {"population": plain_number(pop), "med_income": plain_number(med_income),
+            "mean_age": plain_number(mean_age), "kids": plain_number(kids),
+            "percentages": [percent for percent, _ in percents], "graph": graph}
+
+
+def stats_job(loc_type, location):
+    '''
+    Returns the running or finished community_stats job of a location,
+    starting one if there is none or the last one has expired.
+    '''
+    key = (loc_type, location)
+    now = time.time()
+    with stats_lock:
+        started, job = stats_jobs.get(key, (None, None))
+        if job is None or (job.done() and now - started >= acs.CACHE_TTL):
+            job = stats_pool.submit(community_stats, loc_type, location)
+            stats_jobs[key] = (now, job)
+        stats_jobs.move_to_end(key)
+        while len(stats_jobs) > STATS_JOBS_KEPT:
+            stats_jobs.popitem(last=False)
+    return job
+
+
+def lookup_key(nonprofit, ein_search):
+    '''
+    Returns an EIN, or a name as the database matches it (ignoring the
+    case of ASCII letters and surrounding spaces), for cache keys.
+    '''
+    if ein_search:
+        return df.clean_ein(nonprofit)
+    return re.sub(r"[A-Z]+", lambda letters: letters.group().lower(), nonprofit.strip())
+
+
+def cached_location(nonprofit, version, ein_search=False):
+    '''
+    df.get_location through page_cache, for the given build version.
+    Returns (data_list, np_in_area) as get_location does, which are None
+    if nonprofit isn't an EIN when ein_search is True.
+    '''
+    if ein_search and df.clean_ein(nonprofit) is None:
+        return None, None
+    key = page_cache.cache_key("location", version, ein_search, lookup_key(nonprofit, ein_search))
+    query = df.clean_ein(nonprofit) if ein_search else nonprofit.strip()
+    return page_cache.cached(key, lambda: df.get_location(database_name, query, ein_search))[1]
+
+
+def cached_search(text, version, limit):
+    '''
+    df.search_names through page_cache, for the given build version.
+    '''
+    key = page_cache.cache_key("search", version, limit, " ".join(text.lower().split()))
+    return page_cache.cached(key, lambda: df.search_names(database_name, text, limit))[1]
+
+
+def revalidated(response, built_at):
+    '''
+    Adds an ETag and Last-Modified to a response so browsers and proxies
+    can keep it and ask whether it changed, and answers 304 Not Modified
+    if the request shows it hasn't.
+    '''
+    response.add_etag()
+    response.last_modified = max(built_at, STARTED)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 def lookup_results_help(user, data_list, np_in_area, other_names):
-    # If the nonprofit is found in the database, collect relevant community statistics
+    # If the nonprofit is found in the database, show it right away; the
+    # community statistics are fetched by the page from /stats
     location = ""
     result = data_list[0]
     nonprofit = result["org_name"]
     
-    if result.get("clean_zip(zip)"):
-        location = result.get("clean_zip(zip)")
-        print(location)
+    if result.get("zip5"):
+        location = result.get("zip5")
         loc_type = "zip"
-        acs_data = acs.default(("zip code tabulation area", "*"))
         zipc = location
 
     if not location:
         location = result.get("zip")
         loc_type = "zip"
-        acs_data = acs.default(("zip code tabulation area", "*"))
         zipc = location
 
     if not location:
         location = result.get("state") # This will be two (2) characters
-        print(location)
-        location = acs.STATE_CODES.get(str(location))
         loc_type = "state"
-        acs_data = acs.default(("state", "*")) # This will be the full name
         zipc = "Unknown Zip"
 
-    pop, med_income, mean_age, kids = acs_data.loc[str(location)]
-    acs.make_graph(acs_data, location)
-
-    percents = []
-    for col in acs_data.columns:
-        percents.append([acs.find_percentile(acs_data, col, location), col])
+    stats_url = None
+    if location:
+        #start the job now, so it is running by the time the page asks
+        stats_job(loc_type, acs.STATE_CODES.get(location, location) if loc_type == "state" else location)
+        stats_url = url_for('stats', loc_type=loc_type, location=location)
 
-    return render_template('results.html', title='Results',
+    return render('results.html', title='Results',
         user=user, name=nonprofit, ein=result.get("EIN", "Unknown EIN"),
         zip_code= zipc,
-        city=result.get("city", "Unknown City"),
-        state=result.get("state", "Unknown State"),
-        website=result.get("website", "Unknown Website"),
-        mission=result.get("mission","Unknown Mission"),
-        population=pop, med_income=med_income, mean_age=mean_age,
-        kids=kids, percentages=percents, np=np_in_area,
-        loc_type=loc_type, other_names=other_names, other_nonprofits=data_list[1:],
-        function=results)
+        city=result.get("city") or "Unknown City",
+        state=result.get("state") or "Unknown State",
+        website=result.get("website") or "Unknown Website",
+        mission=result.get("mission") or "Unknown Mission",
+        deductibility=result.get("deductibility_status_code"),
+        revoked=result.get("revoked"), revocation_date=result.get("revocation_date"),
+        np=np_in_area, loc_type=loc_type, stats_url=stats_url,
+        other_names=other_names, other_nonprofits=data_list[1:], function=results)
+
+
+@app.route("/stats/<loc_type>/<location>", methods=["GET"])
+def stats(loc_type, location):
+    # Community statistics of a zip code or state (abbreviation), as JSON.
+    # Answers 202 while they are still being computed; poll until 200.
+    if loc_type not in ACS_GEOS:
+        abort(404)
+    if loc_type == "state":
+        location = acs.STATE_CODES.get(location, location)
+
+    job = stats_job(loc_type, location)
+    if not job.done():
+        return jsonify(status="pending"), 202
+    try:
+        data = job.result()
+    except Exception as e:
+        metrics.log_event("stats_failed", loc_type=loc_type, location=location, error=repr(e))
+        #forget the failed job, so the next page for the area tries again
+        with stats_lock:
+            if stats_jobs.get((loc_type, location), (None, None))[1] is job:
+                del stats_jobs[(loc_type, location)]
+        return jsonify(status="error"), 503
+    if data is None:
+        return jsonify(status="missing"), 404
+    return jsonify(status="done", graph_url=url_for('static', filename=data["graph"]), **data)
+
+
+@app.route("/graphs/<loc_type>/<location>", methods=["GET"])
+def graphs(loc_type, location):
+    # Histogram data behind the results page graphs, as JSON
+    if loc_type not in ACS_GEOS:
+        abort(404)
+    acs_data = acs.default(ACS_GEOS[loc_type])
+    if loc_type == "state":
+        location = acs.STATE_CODES.get(location, location)
+
+    if location not in acs_data.index:
+        abort(404)
+    return jsonify(acs.graph_data(acs_data, location))
 
 
 @app.route("/ein/<ein>", methods=["GET"])
@@ -73,9 +271,20 @@ def lookup(ein):
 
     if request.method == "GET":
 
-        data_list, np_in_area = df.get_location(database_name, ein, True)
+        if df.clean_ein(ein) is None:
+            abort(404)
+        version, built_at = df.build_info(database_name)
 
-        return lookup_results_help(user, data_list, np_in_area, other_names)
+        def build_page():
+            data_list, np_in_area = cached_location(ein, version, True)
+            if not data_list:
+                return None
+            return lookup_results_help(user, data_list, np_in_area, other_names)
+
+        html = page_cache.cached(page_cache.cache_key("page", version, df.clean_ein(ein)), build_page)[1]
+        if html is None:
+            abort(404)
+        return revalidated(app.make_response(html), built_at)
 
 
 @app.route("/results", methods=["POST"])
@@ -87,19 +296,117 @@ def results(EIN = None):
     if request.method == "POST":
 
         #Connect to the IRS database to collect internal information about the nonprofit.
+        version, _ = df.build_info(database_name)
         if EIN:
-            data_list, np_in_area = df.get_location(database_name, EIN, True)
+            data_list, np_in_area = cached_location(EIN, version, True)
         else:
             nonprofit = request.form["nonprofit"]
-            data_list, np_in_area = df.get_location(database_name, nonprofit)
+            data_list, np_in_area = cached_location(nonprofit, version)
 
         if not data_list:
             print("not data_list")
-            return render_template('no_results.html', title='No Results',
-                                   user=user, name=nonprofit)
+            # No exact match, so suggest the closest names instead
+            candidates = cached_search(nonprofit, version, 10)
+            return render('no_results.html', title='No Results',
+                                   user=user, name=nonprofit, candidates=candidates)
 
         return lookup_results_help(user, data_list, np_in_area, other_names)
 
+
+def api_error(message, status=400):
+    # Errors of the JSON API, as JSON
+    return jsonify(error=message), status
+
+
+def page_args(values):
+    '''
+    Reads the offset and limit of a page of results from values (the
+    query string or a JSON body). Returns (offset, limit), or raises
+    ValueError if they aren't sensible.
+    '''
+    try:
+        offset = int(values.get("offset", 0))
+        limit = int(values.get("limit", API_PAGE_SIZE))
+    except TypeError:
+        raise ValueError("offset and limit must be numbers")
+    if offset < 0 or not 0 < limit <= API_MAX_LIMIT:
+        raise ValueError("offset must be 0 or more and limit 1 to " + str(API_MAX_LIMIT))
+    return offset, limit
+
+
+def page(results, offset, limit, more, **fields):
+    # A page of JSON API results, with the offset of the next page if
+    # there are more
+    next_offset = offset + limit if more else None
+    return jsonify(results=results, offset=offset, limit=limit, next_offset=next_offset, **fields)
+
+
+@app.route("/api/ein/<ein>", methods=["GET"])
+def api_ein(ein):
+    # The nonprofit with an EIN, as JSON
+    version, built_at = df.build_info(database_name)
+    data_list, np_in_area = cached_location(ein, version, True)
+    if not data_list:
+        return api_error("No nonprofit with EIN " + ein, 404)
+    return revalidated(jsonify(organizations=data_list, nonprofits_in_area=np_in_area), built_at)
+
+
+@app.route("/api/search", methods=["GET"])
+def api_search():
+    # Ranked name search, as JSON: /api/search?q=helping hands&offset=0&limit=10
+    text = request.args.get("q", "")
+    if not text.strip():
+        return api_error("Missing search text, e.g., ?q=helping hands")
+    try:
+        offset, limit = page_args(request.args)
+    except ValueError as e:
+        return api_error(str(e))
+    #one more than the page, to tell whether there is a next one
+    version, built_at = df.build_info(database_name)
+    results = cached_search(text, version, offset + limit + 1)
+    return revalidated(page(results[offset:offset + limit], offset, limit, len(results) > offset + limit),
+                       built_at)
+
+
+@app.route("/api/batch", methods=["POST"])
+def api_batch():
+    # Looks up many nonprofits at once. Send {"eins": [...]} or
+    # {"names": [...]}; each gets {"query": ..., "matches": [...]} back,
+    # a page at a time (offset and limit, in the body or query string),
+    # or all of them as newline-delimited JSON with ?stream=1.
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("eins", body.get("names")), list):
+        return api_error('Send a JSON object with a list of "eins" or "names".')
+    ein_search = "eins" in body
+    queries = body["eins"] if ein_search else body["names"]
+    if len(queries) > API_MAX_BATCH:
+        return api_error("At most " + str(API_MAX_BATCH) + " EINs or names per request.")
+    if not all(isinstance(query, (str, int)) for query in queries):
+        return api_error("EINs and names must be strings.")
+
+    stream = request.args.get("stream") == "1" or "application/x-ndjson" in request.headers.get("Accept", "")
+    try:
+        offset, limit = page_args(dict(body, **request.args.to_dict()))
+    except ValueError as e:
+        return api_error(str(e))
+    if stream and "limit" not in body and "limit" not in request.args:
+        limit = len(queries)
+    selected = queries[offset:offset + limit]
+    keys = [df.clean_ein(query) if ein_search else str(query) for query in selected]
+    results = zip(selected, df.resolve_batch(database_name, keys, ein_search))
+
+    def entry(query, key, matches):
+        # One query's result; EINs that aren't EINs say so
+        if key is None:
+            return {"query": query, "matches": [], "error": "Not an EIN"}
+        return {"query": query, "matches": matches}
+
+    if stream:
+        lines = (json.dumps(entry(query, *result)) + "\n" for query, result in results)
+        return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+    return page([entry(query, *result) for query, result in results],
+                offset, limit, offset + limit < len(queries), total=len(queries))
+
    
 if __name__ == "__main__":
     #Change to True in case of Internal Server Error to locate the error
@@ -10,6 +10,9 @@ import read_xmls
 import re
 import os
 import csv
+import io
+import zlib
+import multiprocessing as mp
 import progressbar as pb
 import argparse
 import database_functions
@@ -25,8 +28,22 @@ parser.add_argument('-limit', type=int,
                     help='Integer value to limit the number of records created in the database. If none, all are uploaded.')
 parser.add_argument('-specific', help='If given, uploads only the file / folder provided in the command to the database.\
                     Can choose from the following file names: PUB_78_DATA, IRS_990_FORMS, IRS_990N_FORMS, IRS_REVOCATIONS')
-
-args = parser.parse_args()
+parser.add_argument('-batch_size', type=int, default=10000,
+                    help='Number of rows inserted and committed per transaction while loading. Default 10000.')
+parser.add_argument('-pragma', action='append', default=[],
+                    help='Load-time SQLite PRAGMA as name=value, e.g., -pragma synchronous=NORMAL. May be repeated.\
+                    Overrides the defaults in LOAD_PRAGMAS.')
+parser.add_argument('-workers', type=int,
+                    help='Number of processes used to parse the 990 XML files. If none, uses every core.')
+parser.add_argument('-incremental', action='store_true',
+                    help='Updates an existing database instead of replacing it: only loads files that are new\
+                    or changed since the last load, and resumes a load that was interrupted.')
+parser.add_argument('-post_load_only', action='store_true',
+                    help='Skips uploading and only runs the post-load phase (indexes, derived columns,\
+                    area counts and the name search index) on an existing database.')
+parser.add_argument('-export',
+                    help='If given, also exports the tables to typed Parquet files, partitioned by state,\
+                    in this folder (see export_data.py). Needs pyarrow.')
 
 #Hard-coded file names
 #background: https://www.irs.gov/irm/part25/irm_25-007-006
@@ -56,7 +73,7 @@ irs_files = {
 
 "/IRS_Pub_78_Data/data-download-pub78.txt": ("pub_seven_data", ['EIN', 'org_name', 'city','state','country','deductibility_status_code'], "|"), 
 "IRS_990_FORMS": ("nine_nineties", ['Filer:EIN', 'Filer:BusinessName:BusinessNameLine1Txt','Filer:BusinessName:BusinessNameLine2Txt',
-                                    'Filer:USAddress:CityNm','Filer:USAddressLStateAbbreviationCd', 'IRS990:WebsiteAddressTxt',
+                                    'Filer:USAddress:CityNm','Filer:USAddress:StateAbbreviationCd', 'IRS990:WebsiteAddressTxt',
                                     'IRS990:ActivityOrMissionDesc','Filer:USAddress:ZIPCd'], None),
 "/IRS_990N_FORMS/data-download-epostcard.txt":("postcard_forms",['EIN','year','org_name', 'small_org_status', 'termination_status',
                     'fiscal_year_start','fiscal_year_end', 'website', 'contact_name', 'street_address',
@@ -66,10 +83,636 @@ irs_files = {
                     'zip', 'country', 'org_type','date_expired', 'date_posted', 'date_renewed'], "|")
 }
 
+#Zip archives downloaded by download_data.py, as irs_files key:
+#(archive, member). When a file or folder hasn't been extracted, it is
+#read straight out of its archive; None means every xml in the archive.
+ARCHIVES = {"/IRS_Pub_78_Data/data-download-pub78.txt": ("data-download-pub78.zip", "data-download-pub78.txt"),
+            "IRS_990_FORMS": ("990AllXML.zip", None),
+            "/IRS_990N_FORMS/data-download-epostcard.txt": ("data-download-epostcard.zip", "data-download-epostcard.txt"),
+            "/IRS_Revocations/data-download-revocation.txt": ("data-download-revocation.zip", "data-download-revocation.txt")}
+
+#Typed history of the 990 filings, one row per EIN and tax year, filled
+#in while the 990 forms are loaded. Its value columns are
+#read_xmls.NUMERIC_990_FIELDS; the key and filing columns come from these
+#labels. object_id is the IRS's ID of the filing (its file name) and
+#filing_id the rowid of the filing's row in nine_nineties.
+FINANCIALS_TABLE = "financials"
+FINANCIALS_KEYS = {'EIN': 'Filer:EIN', 'tax_year': 'TaxYr'}
+FILING_DETAILS = {'tax_period': 'TaxPeriodEndDt', 'return_type': 'ReturnTypeCd'}
+FINANCIALS_LABELS = (list(FINANCIALS_KEYS.values()) + list(FILING_DETAILS.values())
+                     + list(read_xmls.NUMERIC_990_FIELDS.values()))
+FINANCIALS_COLUMNS = (list(FINANCIALS_KEYS) + list(FILING_DETAILS) + list(read_xmls.NUMERIC_990_FIELDS)
+                      + ["object_id", "filing_id"])
+
+#PRAGMAs applied to the connection while loading. Nothing is read back
+#until the build finishes, so durability is traded for speed. WAL keeps
+#the file intact if the build crashes, so -incremental can resume it; the
+#database is switched back to the default journal when the build ends.
+LOAD_PRAGMAS = {"journal_mode": "WAL",
+                "synchronous": "OFF",
+                "cache_size": -200000, #negative values are KiB, so ~200MB
+                "temp_store": "MEMORY"}
+
+#load_manifest source of the tables post_load still has to run on, one
+#member per table, so an interrupted build is finished by the next run
+POST_LOAD_SOURCE = "post_load"
+
 #for testing 990 forms only
 #irs_files = {IRS_990_FORMS: ("nine_nineties", ['EIN', 'BusinessNameLine1Txt','ZIPCd', 'TotalVolunteersCnt'], None)}
 
-def create_database(database_name, save_location=None, limit=None, file_to_upload=None):
+def apply_pragmas(conn, pragmas):
+    '''
+    Sets each PRAGMA on the connection.
+    Inputs: conn: sqlite3 connection
+            pragmas: dictionary of pragma name: value
+    Returns: None
+    '''
+    for name, value in pragmas.items():
+        conn.execute("PRAGMA " + name + " = " + str(value) + ";")
+
+
+def parse_pragmas(pragma_args):
+    '''
+    Turns command line name=value strings into a dictionary of pragmas.
+    '''
+    pragmas = {}
+    for pragma in pragma_args:
+        name, _, value = pragma.partition("=")
+        pragmas[name.strip()] = value.strip()
+    return pragmas
+
+
+def insert_query(table_name, field_names, replace=False):
+    '''
+    Builds the INSERT statement for a table once, so it can be
+    reused (and prepared once by sqlite3) for every row. If replace,
+    a row replaces any row with the same primary key.
+    '''
+    return (("INSERT OR REPLACE INTO " if replace else "INSERT INTO ") + table_name + " (" + ", ".join(field_names) +
+            ") VALUES (" + ", ".join(["?"] * len(field_names)) + ");")
+
+
+def create_manifest(conn):
+    '''
+    Creates the load_manifest table, which records every source file
+    loaded into the database: its size, modification time and CRC-32
+    checksum (the one zip archives store), its status ('loading', 'done'
+    or 'failed'), how many rows of it have been committed, and (for 990
+    forms) the rowid of its row.
+    '''
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS load_manifest (source, member, size, mtime, "
+                     "hash, status, rows, row_id, loaded_at, PRIMARY KEY (source, member));")
+
+
+def get_manifest(conn, source):
+    '''
+    Returns the manifest entries for one source as a dictionary of
+    member: (size, mtime, hash, status, rows, row_id). Pipe-delimited
+    files have a single member, "".
+    '''
+    r = conn.execute("SELECT member, size, mtime, hash, status, rows, row_id "
+                     "FROM load_manifest WHERE source = ?;", (source, ))
+    return {row[0]: tuple(row[1:]) for row in r}
+
+
+def manifest_entry(source, member, size, mtime, file_hash, status, rows=0, row_id=None):
+    '''
+    Returns the (query, parameters) that record a manifest entry, to run
+    in the same transaction as the rows it describes.
+    '''
+    return ("INSERT OR REPLACE INTO load_manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'));",
+            (source, member, size, mtime, file_hash, status, rows, row_id))
+
+
+def mark_pending(conn, table_name):
+    '''
+    Records in the manifest, before a table is (re)loaded, that post_load
+    has to run on it, so a load that is interrupted before post_load
+    finishes is merged on the next run. Keeps the time it was first
+    marked if it already was.
+    '''
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO load_manifest (source, member, status, loaded_at) "
+                     "VALUES (?, ?, 'pending', datetime('now'));", (POST_LOAD_SOURCE, table_name))
+
+
+def unmark_pending(conn, table_name):
+    '''
+    Removes a table's post_load mark, e.g., when none of its files changed.
+    '''
+    with conn:
+        conn.execute("DELETE FROM load_manifest WHERE source = ? AND member = ?;",
+                     (POST_LOAD_SOURCE, table_name))
+
+
+def get_pending(conn):
+    '''
+    Returns the tables post_load still has to run on, as a dictionary of
+    table name: when it was marked (datetime('now') text).
+    '''
+    r = conn.execute("SELECT member, loaded_at FROM load_manifest WHERE source = ?;",
+                     (POST_LOAD_SOURCE, ))
+    return dict(r.fetchall())
+
+
+def create_financials(conn):
+    '''
+    Creates the financials table, adding columns for any numeric fields
+    added to read_xmls.NUMERIC_990_FIELDS (or filing details added to
+    FILING_DETAILS) since it was created. Forms loaded before a column
+    was added have no value for it until they are reloaded. The primary
+    key also indexes each organization's filings by tax year.
+    '''
+    text_columns = list(FILING_DETAILS) + ["object_id"]
+    columns = [(column, "TEXT" if column in text_columns else "INTEGER")
+               for column in FINANCIALS_COLUMNS[len(FINANCIALS_KEYS):]]
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS " + FINANCIALS_TABLE + " (EIN TEXT, tax_year INTEGER, "
+                     + ", ".join(column + " " + kind for column, kind in columns)
+                     + ", PRIMARY KEY (EIN, tax_year));")
+        existing = database_functions.get_columns(conn, FINANCIALS_TABLE)
+        for column, kind in columns:
+            if column not in existing:
+                conn.execute("ALTER TABLE " + FINANCIALS_TABLE + " ADD COLUMN " + column + " " + kind + ";")
+        conn.execute("CREATE INDEX IF NOT EXISTS " + FINANCIALS_TABLE + "_filing_id_idx ON "
+                     + FINANCIALS_TABLE + " (filing_id);")
+
+
+def financials_query():
+    '''
+    Builds the statement that adds a filing to the financials table.
+    A filing only replaces the one already there for the same EIN and
+    tax year if its object ID is at least as high: object IDs grow
+    with the date the IRS processed the return, so an amended return
+    wins over the original whatever order the forms are loaded in.
+    '''
+    return (insert_query(FINANCIALS_TABLE, FINANCIALS_COLUMNS)[:-1] + " ON CONFLICT (EIN, tax_year) DO UPDATE SET "
+            + ", ".join(column + " = excluded." + column for column in FINANCIALS_COLUMNS[len(FINANCIALS_KEYS):])
+            + " WHERE " + FINANCIALS_TABLE + ".object_id IS NULL OR excluded.object_id >= "
+            + FINANCIALS_TABLE + ".object_id;")
+
+
+def financials_row(values):
+    '''
+    Converts the FINANCIALS_LABELS values extracted from a form to a
+    financials row: EIN, the tax year, the FILING_DETAILS as text, then
+    ints (None where blank or not a number). Returns None if the form
+    has no EIN or tax year.
+    '''
+    details = len(FINANCIALS_KEYS) + len(FILING_DETAILS)
+    row = [values[0]]
+    for position, value in enumerate(values[1:], 1):
+        if len(FINANCIALS_KEYS) <= position < details:
+            row.append(value or None)
+            continue
+        try:
+            row.append(int(value))
+        except (TypeError, ValueError):
+            row.append(None)
+    if not row[0] or row[1] is None:
+        return None
+    return row
+
+
+def object_id(record):
+    '''
+    Returns the IRS's object ID of a 990 record, the start of its file
+    name, e.g., '201600000000000000' for 201600000000000000_public.xml.
+    '''
+    return os.path.basename(read_xmls.record_name(record)).split("_")[0]
+
+
+def source_location(file):
+    '''
+    Returns where to read one of the irs_files from: its extracted file
+    or folder if there is one, otherwise its zip archive (for the 990
+    forms) or (archive, member). Returns None if neither is here.
+    '''
+    archive, member = ARCHIVES[file]
+    if irs_files[file][2] is None:
+        if os.path.isdir(file):
+            return file
+        return archive if os.path.isfile(archive) else None
+    if os.path.isfile(os.getcwd() + file):
+        return os.getcwd() + file
+    return (archive, member) if os.path.isfile(archive) else None
+
+
+def hash_file(location):
+    '''
+    Returns the CRC-32 checksum of a file (or archive member from
+    read_xmls.list_records) as hex, read a megabyte at a time. For
+    archive members the checksum stored in the archive is used.
+    '''
+    crc = read_xmls.record_info(location)[2]
+    if crc:
+        return crc
+    crc = 0
+    with read_xmls.open_record(location) as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            crc = zlib.crc32(block, crc)
+    return "%08x" % crc
+
+
+class CRCReader:
+    '''
+    Wraps a binary file, computing the CRC-32 checksum of what is read
+    through it, so a file can be parsed and hashed in one pass.
+    '''
+    def __init__(self, file):
+        self.file = file
+        self.crc = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.crc = zlib.crc32(data, self.crc)
+        return data
+
+    def checksum(self):
+        '''
+        Reads whatever the parser left unread (it stops once it has every
+        field) and returns the checksum of the whole file as hex.
+        '''
+        for block in iter(lambda: self.read(1 << 20), b""):
+            pass
+        return "%08x" % self.crc
+
+
+def insert_chunk(conn, query, rows, failures, source, field_names, bookkeeping=None):
+    '''
+    Inserts a chunk of rows inside a single transaction. If the chunk
+    fails as a whole, it is retried row by row so only the bad rows are
+    recorded in failures.
+    Inputs: conn: sqlite3 connection
+            query: INSERT statement from insert_query
+            rows: list of lists of field values
+            failures: dictionary of failed uploads, updated in place
+            source: file the rows came from
+            field_names: list of column names, kept with failed rows
+            bookkeeping: (query, parameters) to run in the same transaction,
+                e.g., from manifest_entry
+    Returns: None
+    '''
+    try:
+        with conn:
+            conn.executemany(query, rows)
+            if bookkeeping:
+                conn.execute(*bookkeeping)
+    except sqlite3.Error:
+        with conn:
+            for row in rows:
+                try:
+                    conn.execute(query, row)
+                except sqlite3.Error:
+                    failures.setdefault(source, []).append((field_names, row))
+            if bookkeeping:
+                conn.execute(*bookkeeping)
+
+
+def read_chunks(data, delimiter, chunk_size, limit=None, start=0):
+    '''
+    Streams a delimited file in chunks of split rows, skipping blank lines.
+    Inputs: data: open file (or any iterable of lines)
+            delimiter: field delimiter, e.g., "|"
+            chunk_size: number of rows per chunk
+            limit: maximum number of rows to read, counting skipped rows (int)
+            start: number of rows to skip first, e.g., when resuming (int)
+    Returns: generator of lists of rows
+    '''
+    chunk = []
+    count = 0
+    for line in data:
+        if limit and count >= limit:
+            break
+        line = line.rstrip()
+        if not line:
+            continue
+        count += 1
+        if count <= start:
+            continue
+        chunk.append(line.split(delimiter))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_delimited_file(conn, location, source, table_name, field_names, delimiter,
+                        limit=None, batch_size=10000, failures=None):
+    '''
+    Bulk loads one of the pipe-delimited IRS files into its table,
+    committing every batch_size rows along with the number of rows
+    committed so far in load_manifest. Rows with the wrong number of
+    fields are recorded as failures without touching the database.
+    A file already loaded with the same contents is skipped; a load
+    that was interrupted resumes after its last committed batch; a
+    changed file replaces the table's rows.
+    Inputs: conn: sqlite3 connection
+            location: path to the delimited file, or (archive, member) to
+                stream it out of a zip archive
+            source: irs_files key of the file
+            table_name, field_names, delimiter: from irs_files
+            limit: maximum number of rows to upload (int)
+            batch_size: rows per transaction (int)
+            failures: dictionary of failed uploads, updated in place
+    Returns: True if the table changed, False if the file was skipped
+    '''
+    if failures is None:
+        failures = {}
+    size, mtime, _ = read_xmls.record_info(location)
+    file_path = location if isinstance(location, str) else ":".join(location)
+    entry = get_manifest(conn, source).get("")
+    if entry and entry[3] == "done" and entry[:2] == (size, mtime):
+        print("Unchanged since it was last loaded, skipping.")
+        return False
+
+    file_hash = hash_file(location)
+    start = 0
+    if entry and entry[2] == file_hash:
+        if entry[3] == "done":
+            with conn:
+                conn.execute(*manifest_entry(source, "", size, mtime,
+                                             file_hash, "done", entry[4]))
+            print("Unchanged since it was last loaded, skipping.")
+            return False
+        start = entry[4]
+        print("Resuming after row " + str(start))
+    else:
+        with conn:
+            conn.execute("DELETE FROM " + table_name + ";")
+            conn.execute(*manifest_entry(source, "", size, mtime,
+                                         file_hash, "loading"))
+
+    query = insert_query(table_name, field_names)
+    progress = pb.ProgressBar(maxval = pb.UnknownLength).start()
+    progvar = start
+
+    with io.TextIOWrapper(read_xmls.open_record(location)) as data_to_upload:
+        for chunk in read_chunks(data_to_upload, delimiter, batch_size, limit, start):
+            rows = []
+            for fields in chunk:
+                if len(fields) == len(field_names):
+                    rows.append(fields)
+                else:
+                    failures.setdefault(file_path, []).append((field_names, fields))
+            progvar += len(chunk)
+            insert_chunk(conn, query, rows, failures, file_path, field_names,
+                         manifest_entry(source, "", size, mtime,
+                                        file_hash, "loading", progvar))
+            progress.update(progvar)
+
+    #stopping at the limit leaves the file 'loading', to be finished later
+    if not (limit and progvar >= limit):
+        with conn:
+            conn.execute(*manifest_entry(source, "", size, mtime,
+                                         file_hash, "done", progvar))
+    return True
+
+
+def extract_990_record(record, compiled_fields):
+    '''
+    Reads a single IRS 990 XML file and returns the values of the
+    compiled long-label field names, in order, along with what the
+    manifest records about the file. Fields missing from the form
+    are returned as "".
+    Inputs: record: xml file from read_xmls.list_records, either a path
+                or (archive, member) to read it straight out of a zip archive
+            compiled_fields: long labels prepared by read_xmls.compile_fields
+    Returns: tuple of (list of field values or None if the file can't be
+        parsed, size, mtime, CRC-32 checksum)
+    '''
+    size, mtime, file_hash = read_xmls.record_info(record)
+    with read_xmls.open_record(record) as data_to_upload:
+        #archive members come with their CRC; files are hashed as they are parsed
+        reader = data_to_upload if file_hash else CRCReader(data_to_upload)
+        try:
+            fields = read_xmls.extract_fields(reader, compiled_fields)
+        except Exception:
+            fields = None
+        if not file_hash:
+            file_hash = reader.checksum()
+    return fields, size, mtime, file_hash
+
+
+def parse_worker(paths, rows, compiled_fields):
+    '''
+    Worker process: takes 990 records off the paths queue until it
+    gets None, and puts (record, fields, size, mtime, hash) on the rows
+    queue. fields is None when the file could not be parsed. Puts None
+    on the rows queue when finished.
+    '''
+    for record_path in iter(paths.get, None):
+        try:
+            record = extract_990_record(record_path, compiled_fields)
+        #a bad file must not kill the worker, or the writer waits forever
+        except Exception:
+            record = (None, None, None, None)
+        rows.put((record_path, ) + record)
+    rows.put(None)
+
+
+def extract_990_records(record_paths, compiled_fields, workers=None, queue_size=1000):
+    '''
+    Extracts fields from each 990 file across a pool of worker processes.
+    Extracted rows come back through a bounded queue, so workers pause
+    when the database writer falls behind.
+    Inputs: record_paths: list of xml files from read_xmls.list_records
+            compiled_fields: long labels prepared by read_xmls.compile_fields
+            workers: number of processes (int). If none, uses every core.
+            queue_size: maximum number of rows waiting to be written
+    Returns: generator of (record, fields, size, mtime, hash) tuples,
+        in no particular order
+    '''
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for record_path in record_paths:
+            try:
+                yield (record_path, ) + extract_990_record(record_path, compiled_fields)
+            except Exception:
+                yield record_path, None, None, None, None
+        return
+
+    paths = mp.Queue()
+    rows = mp.Queue(queue_size)
+    processes = [mp.Process(target=parse_worker, args=(paths, rows, compiled_fields), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for record_path in record_paths:
+        paths.put(record_path)
+    for _ in processes:
+        paths.put(None)
+
+    finished = 0
+    try:
+        while finished < len(processes):
+            row = rows.get()
+            if row is None:
+                finished += 1
+            else:
+                yield row
+    finally:
+        for process in processes:
+            if finished < len(processes):
+                process.terminate()
+            process.join()
+
+
+def write_990_batch(conn, query, batch, source, table_name, manifest, failures,
+                    financials_query=None):
+    '''
+    Writes a batch of extracted 990 forms, and their manifest entries,
+    in one transaction. A changed form replaces the row it loaded before;
+    a form whose contents haven't changed only has its entry updated.
+    Inputs: conn: sqlite3 connection
+            query: INSERT statement from insert_query
+            batch: list of (record, fields, size, mtime, hash) tuples. If
+                financials_query is given, fields end with FINANCIALS_LABELS.
+            source: manifest source name of the forms
+            table_name: table to fill
+            manifest: dictionary from get_manifest, for this source
+            failures: dictionary of failed uploads, updated in place
+            financials_query: statement from financials_query
+    Returns: None
+    '''
+    with conn:
+        for record_path, fields, size, mtime, file_hash in batch:
+            record = read_xmls.record_name(record_path)
+            entry = manifest.get(record)
+            if entry and file_hash and entry[2] == file_hash:
+                conn.execute(*manifest_entry(source, record, size, mtime, file_hash,
+                                             entry[3], entry[4], entry[5]))
+                continue
+            #rowids stay put because the table is never vacuumed
+            if entry and entry[5] is not None:
+                conn.execute("DELETE FROM " + table_name + " WHERE rowid = ?;", (entry[5], ))
+
+            row_id = None
+            if fields is None:
+                failures[record_path] = failures.get(record_path, "fail")
+            else:
+                if financials_query:
+                    numbers = financials_row(fields[-len(FINANCIALS_LABELS):])
+                    fields = fields[:-len(FINANCIALS_LABELS)]
+                try:
+                    row_id = conn.execute(query, fields).lastrowid
+                    if financials_query and numbers:
+                        conn.execute(financials_query, numbers + [object_id(record_path), row_id])
+                except sqlite3.Error:
+                    failures[record_path] = failures.get(record_path, []) + [(fields)]
+            conn.execute(*manifest_entry(source, record, size, mtime, file_hash,
+                                         "failed" if row_id is None else "done",
+                                         0 if row_id is None else 1, row_id))
+
+
+def load_990_forms(conn, location, source, table_name, field_names, column_names, limit=None,
+                   batch_size=10000, workers=None, failures=None):
+    '''
+    Loads the 990 XML files in a folder, or straight out of a zip
+    archive, into its table, and their numeric fields into the
+    financials table. Files already in load_manifest with the same
+    size and modification time are skipped, so only new or changed
+    forms are parsed. Parsing is spread across
+    worker processes while this process is the only one writing to the
+    database, a batch_size chunk at a time. Each batch is committed with
+    its manifest entries, so an interrupted load picks up where it left off.
+    Inputs: conn: sqlite3 connection
+            location: folder or zip archive of 990 xml files
+            source: irs_files key of the forms
+            table_name: table to fill
+            field_names: long labels to extract from each form
+            column_names: table columns, in the same order as field_names
+            limit: maximum number of forms to upload (int)
+            batch_size: rows per transaction (int)
+            workers: number of parsing processes (int)
+            failures: dictionary of failed uploads, updated in place
+    Returns: True if the table changed, False if there was nothing to load
+    '''
+    if failures is None:
+        failures = {}
+    manifest = get_manifest(conn, source)
+    record_paths = []
+    for record in read_xmls.list_records(location):
+        entry = manifest.get(read_xmls.record_name(record))
+        if entry and entry[:2] == read_xmls.record_info(record)[:2]:
+            continue
+        record_paths.append(record)
+    if limit:
+        record_paths = record_paths[:limit]
+    if not record_paths:
+        print("No new or changed forms, skipping.")
+        return False
+    query = insert_query(table_name, column_names)
+    create_financials(conn)
+    history_query = financials_query()
+    compiled_fields = read_xmls.compile_fields(field_names + FINANCIALS_LABELS)
+
+    progress = pb.ProgressBar(maxval = pb.UnknownLength).start()
+    progvar = 0
+    batch = []
+    for record in extract_990_records(record_paths, compiled_fields, workers):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            write_990_batch(conn, query, batch, source, table_name, manifest, failures,
+                            history_query)
+            batch = []
+        progvar += 1
+        progress.update(progvar)
+    if batch:
+        write_990_batch(conn, query, batch, source, table_name, manifest, failures,
+                        history_query)
+
+    return True
+
+
+def post_load(conn, tables=None, since=None):
+    '''
+    Runs once the tables are loaded: builds the zip5 columns, the
+    lookup indexes, the per-area nonprofit counts and the merged
+    organizations table used by database_functions.get_location, and
+    the full-text name index used by database_functions.search_names.
+    Stamps a new build version, which expires the app's cached pages,
+    and clears the tables' post_load marks (see mark_pending).
+    Inputs: conn: sqlite3 connection
+            tables: list of table names that were (re)loaded. If none, all tables.
+            since: when this load started (datetime('now') text), so only
+                the 990 forms loaded since are merged into organizations again
+    Returns: None
+    '''
+    print("\nBuilding indexes.")
+    database_functions.build_indexes(conn, tables)
+    print("Counting nonprofits by zip code and city.")
+    database_functions.refresh_area_counts(conn, tables)
+    print("Merging the tables into organizations.")
+    database_functions.refresh_organizations(conn, tables, since)
+    print("Building the name search index.")
+    try:
+        database_functions.build_search_index(conn, tables)
+    except sqlite3.OperationalError as e:
+        print("Skipping the search index, this sqlite3 can't build it: " + str(e))
+    database_functions.stamp_build(conn)
+    create_manifest(conn)
+    for table_name in tables or get_pending(conn):
+        unmark_pending(conn, table_name)
+
+
+def export(conn, export_dir):
+    '''
+    Exports the tables to Parquet files in export_dir (see export_data.py).
+    '''
+    #pyarrow is only needed when exporting
+    import export_data
+    print("\nExporting to " + export_dir)
+    counts = export_data.export_database(conn, export_dir)
+    for table, count in counts.items():
+        print(table + ": " + str(count) + " rows")
+
+
+def create_database(database_name, save_location=None, limit=None, file_to_upload=None,
+                    batch_size=10000, pragmas=None, workers=None, post_load_only=False,
+                    incremental=False, export_dir=None):
     '''
     Creates a Sqlite3 database with given name and in
     provided save location with data on nonprofits from 
@@ -82,7 +725,15 @@ def create_database(database_name, save_location=None, limit=None, file_to_uploa
             save_location: (location to place the database) Written as "folder/".
                 If none, uses current working directory
             limit: whether to limit the number of files uplaoded (int)
-            file_to_upload: specific IRS data file to upload rather than uploading all of them. 
+            file_to_upload: specific IRS data file to upload rather than uploading all of them.
+            batch_size: number of rows inserted per transaction (int)
+            pragmas: dictionary of load-time PRAGMAs overriding LOAD_PRAGMAS
+            workers: number of processes parsing 990 XML files (int).
+                If none, uses every core.
+            post_load_only: if True, only runs post_load on an existing database
+            incremental: if True, updates an existing database with only the new or
+                changed files (see load_manifest) instead of replacing it
+            export_dir: if given, exports the tables to Parquet in this folder
     Returns: None
     '''
     if not database_name:
@@ -95,9 +746,20 @@ def create_database(database_name, save_location=None, limit=None, file_to_uploa
             database_name = save_location + database_name
         else:
             database_name = save_location + "/" + database_name
+    if post_load_only:
+        conn = sqlite3.connect(database_name)
+        try:
+            post_load(conn)
+            if export_dir:
+                export(conn, export_dir)
+        finally:
+            conn.execute("PRAGMA journal_mode = DELETE;")
+            conn.close()
+        return {}
+
     # Checks if a database with the same name already exists
     for file in os.listdir():
-        if file == database_name:
+        if file == database_name and not incremental:
             print("Seems like there is already a database with the name " + database_name)
             print("Do you want to overwrite it?")
             proceed = input("Y if continue; N if quit: ")
@@ -110,7 +772,10 @@ def create_database(database_name, save_location=None, limit=None, file_to_uploa
                 print("Didn't understand that. Run the program again!")
                 return None
 
-    print("\nAlright, we're creating a new database at " + database_name)
+    if incremental:
+        print("\nAlright, we're updating the database at " + database_name)
+    else:
+        print("\nAlright, we're creating a new database at " + database_name)
 
     #Create list of what files to upload
     new_files = []
@@ -126,119 +791,92 @@ def create_database(database_name, save_location=None, limit=None, file_to_uploa
 
     #Connect to database
     conn = sqlite3.connect(database_name)
+    load_pragmas = dict(LOAD_PRAGMAS)
+    load_pragmas.update(pragmas or {})
+    apply_pragmas(conn, load_pragmas)
     #Do we need to create any functions when querying?
     conn.create_function('clean_zip', 1, database_functions.clean_zip_codes)
+    create_manifest(conn)
+    started = conn.execute("SELECT datetime('now');").fetchone()[0]
+    #tables an interrupted load changed but didn't finish post_load on
+    pending = get_pending(conn)
+    if pending:
+        print("\nThe last load didn't finish, so it'll be finished too: " + ", ".join(pending))
     c = conn.cursor()
     failures = {}
+    changed_tables = list(pending)
     #loop through files and build tables
 
     print("\nThis'll take a few minutes. Grab a coffee, maybe a snack.")
     print("Or just watch the progress bars going back and forth, that's cool too.\n No judgement here.\n")
 
-    for file in new_files.keys():
-        #construct table
-        print(file_names[file], irs_file_times[file])
-        file_path = os.getcwd() + file
-        table_name, field_names, delimiter = new_files[file]
-        #Use consistent naming for the IR_990 table.
-        if os.path.isdir(file):
-            new_field_names = ['EIN', 'org_name','org_name_2', 'city', 'state', 'website','mission', 'zip']
-            field_names = new_field_names
+    try:
+        for file in new_files.keys():
+            #construct table
+            print(file_names[file], irs_file_times[file])
+            table_name, field_names, delimiter = new_files[file]
+            location = source_location(file)
+            #Use consistent naming for the IR_990 table.
+            if delimiter is None:
+                new_field_names = ['EIN', 'org_name','org_name_2', 'city', 'state', 'website','mission', 'zip']
+                field_names = new_field_names
 
-        query = "CREATE TABLE IF NOT EXISTS " + table_name + " (" + ", ".join(field_names) + ");"
+            if not location:
+                print("Couldn't find " + file + ", check your filename! Skipping it.")
+                continue
 
-        c.execute(query)
+            query = "CREATE TABLE IF NOT EXISTS " + table_name + " (" + ", ".join(field_names) + ");"
 
-        if os.path.isdir(file):
-            #IRS 990 XML files
-            #visualize progress while filling IRS tables
-
-            print("\nMaybe look up that video of pandas going down the slide?\n")
-
-            progress = pb.ProgressBar(maxval = pb.UnknownLength).start()
-            progvar = 0
-            limit_arg = 0
-            #iterate through all of the IRS files
-            for record in os.listdir(file):
-                if (limit) and (limit_arg >= limit):
-                    break
-                #append file path
-                record_path = os.getcwd() + "/"+ file + "/" + record
-
-                with open(record_path, 'r') as data_to_upload:
-                    #read xml into elementtree
-                    #avoid any decoding errors
-                    try:
-                        xml = read_xmls.read_xml(data_to_upload)
-
-                        #clean xml of schema
-                        read_xmls.clean_xml(xml)
-                        #write long labels for field names
-                        read_xmls.write_long_labels(xml)
-
-                    except (UnicodeDecodeError, IndexError):
-                        failures[record_path] = failures.get(record_path, "fail")
-                        pass
-                    #search xml using original field names to get the fields
-                    _, field_names, _ = new_files[file]
-                    fields = []
-
-                    for i in field_names:
-                        try:
-                            fields.append(read_xmls.search_tree(xml, i)[i]) 
-                        except KeyError:
-                            fields.append("")
-                    #Insert the fields into the database
-                    try:
-                        c.execute("INSERT INTO " + table_name + "( " + ", ".join(new_field_names) +
-                                     ") VAlUES (" + ", ".join(["(?)"]*len(new_field_names)) + ");", fields)
-                    except:
-                        failures[record_path] = failures.get(record_path, []) + [(fields)]    
-
-                limit_arg += 1
-                progress.update(progvar + 1)
-                progvar += 1
-
-            print("\nDid you look up the panda video?? Seriously, look it up. Here's a link:")
-            print("https://www.youtube.com/watch?v=sGF6bOi1NfA")
-
-        elif os.path.isfile(file_path):
-        #Create option when given a single file with multiple organizations included.
-            limit_arg = 0
-            with open(file_path, 'r') as data_to_upload:
-                
+            c.execute(query)
+            mark_pending(conn, table_name)
+
+            if delimiter is None:
+                #IRS 990 XML files, extracted or still zipped
                 #visualize progress while filling IRS tables
 
-                progress = pb.ProgressBar(maxval = pb.UnknownLength).start()
-                progvar = 0
-
-                for line in data_to_upload:
-                    if (limit) and (limit_arg >= limit):
-                        break
-                    fields = line.rstrip()
-                    fields = fields.split("|")
-                    if fields != ['']:
-
-                        try:
-                            c.execute("INSERT INTO " + table_name + " ( " + ", ".join(field_names)
-                             + ") VALUES (" + ", ".join(["(?)"]*len(field_names)) + ");", fields)
-                        except:
-                            failures[file_path] = failures.get(file_path, []) + [(field_names, fields)]
-                    
-                        limit_arg += 1
-                    progress.update(progvar + 1)
-                    progvar += 1
-        else:
-            return "Check your filename!"
+                print("\nMaybe look up that video of pandas going down the slide?\n")
+
+                _, xml_field_names, _ = new_files[file]
+                changed = load_990_forms(conn, location, file, table_name, xml_field_names,
+                                         new_field_names, limit, batch_size, workers, failures)
 
-    print("\nAll finished up here!")
+                print("\nDid you look up the panda video?? Seriously, look it up. Here's a link:")
+                print("https://www.youtube.com/watch?v=sGF6bOi1NfA")
 
-    conn.commit()
-    c.close()
+            else:
+            #Create option when given a single file with multiple organizations included.
+                changed = load_delimited_file(conn, location, file, table_name, field_names, delimiter,
+                                              limit, batch_size, failures)
+            if changed and table_name not in changed_tables:
+                changed_tables.append(table_name)
+            elif not changed and table_name not in pending:
+                unmark_pending(conn, table_name)
+
+        conn.commit()
+        if changed_tables:
+            #990 forms loaded by an interrupted load are merged too
+            post_load(conn, changed_tables, min(list(pending.values()) + [started]))
+
+        if export_dir:
+            export(conn, export_dir)
+
+        print("\nAll finished up here!")
+
+        conn.commit()
+    finally:
+        #an interrupted load is rolled back to its last batch; the tables
+        #it changed are still marked, so the next run finishes post_load
+        conn.rollback()
+        c.close()
+        conn.execute("PRAGMA journal_mode = DELETE;")
+        conn.close()
 
     print("There were " + str(len(failures)) + " files that weren't uploaded properly.")
     return failures
 
 
 if __name__ == "__main__":
-    create_database(args.filename, args.save_location, args.limit, args.specific)
\ No newline at end of file
+    args = parser.parse_args()
+    create_database(args.filename, args.save_location, args.limit, args.specific,
+                    args.batch_size, parse_pragmas(args.pragma), args.workers, args.post_load_only,
+                    args.incremental, args.export)
\ No newline at end of file
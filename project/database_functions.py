@@ -3,21 +3,206 @@
 The following functions are used by create_database.py.
 '''
 import sqlite3
+import numpy as np
+import re
+import difflib
+import os
+import queue
+import threading
+import contextlib
+import datetime
+import urllib.parse
+import read_xmls
+import metrics
 
 ZIP_TABLES = ['postcard_forms', 'irs_revocations', 'nine_nineties', 'pub_seven_data']
 
+#Tables with a zip column. Each gets a stored zip5 column holding the
+#5 digit zip, so lookups can use an index instead of calling clean_zip.
+ZIP5_TABLES = ['postcard_forms', 'irs_revocations', 'nine_nineties']
+
+#Indexes built once the tables are loaded; each entry is a list of
+#indexed columns. org_name is indexed NOCASE to match name searches.
+INDEXES = {
+    'postcard_forms': [['EIN'], ['org_name COLLATE NOCASE'], ['zip5']],
+    'irs_revocations': [['EIN'], ['org_name COLLATE NOCASE'], ['zip5']],
+    'nine_nineties': [['EIN'], ['org_name COLLATE NOCASE'], ['zip5'], ['state']],
+    'pub_seven_data': [['EIN'], ['org_name COLLATE NOCASE'], ['city', 'state']],
+}
+
+#Columns of the merged organizations table, each with the source
+#(table, column) pairs it is taken from, best first; the first one
+#that isn't blank wins. Pub 78 is the IRS's current name for an EIN;
+#the latest 990 has the most complete address and description.
+ORGANIZATION_COLUMNS = [
+    ('org_name', [('pub_seven_data', 'org_name'), ('nine_nineties', 'org_name'),
+                  ('postcard_forms', 'org_name'), ('irs_revocations', 'org_name')]),
+    ('alt_name', [('nine_nineties', 'org_name_2'), ('postcard_forms', 'dba_name_1'),
+                  ('irs_revocations', 'alt_name')]),
+    ('city', [('nine_nineties', 'city'), ('postcard_forms', 'city'),
+              ('irs_revocations', 'city'), ('pub_seven_data', 'city')]),
+    ('state', [('nine_nineties', 'state'), ('postcard_forms', 'state'),
+               ('irs_revocations', 'state'), ('pub_seven_data', 'state')]),
+    ('zip5', [('nine_nineties', 'zip5'), ('postcard_forms', 'zip5'), ('irs_revocations', 'zip5')]),
+    ('website', [('nine_nineties', 'website'), ('postcard_forms', 'website')]),
+    ('mission', [('nine_nineties', 'mission')]),
+    ('deductibility_status_code', [('pub_seven_data', 'deductibility_status_code')]),
+    ('revocation_date', [('irs_revocations', 'date_expired')]),
+    ('reinstatement_date', [('irs_revocations', 'date_renewed')]),
+]
+
+#Which row of each source table an organization is built from, when
+#an EIN has several: the 990-N of the latest year, otherwise any. For
+#the 990s, see LATEST_FILING.
+ORGANIZATION_ROWS = {
+    'postcard_forms': "ORDER BY year DESC",
+}
+
+#The 990 an organization is built from: its latest tax year, and the
+#latest amendment of it, from the financials table. Rowids say nothing
+#about filing order: forms are loaded in no particular order, and
+#reloaded forms get new rowids.
+LATEST_FILING = ("SELECT n.rowid FROM nine_nineties n LEFT JOIN financials f ON f.filing_id = n.rowid "
+                 "WHERE n.EIN = e.EIN ORDER BY f.tax_year DESC, f.object_id DESC, n.rowid DESC LIMIT 1")
+
+#Text indexed by org_search for each source table:
+#(name, alternate names, mission)
+SEARCH_COLUMNS = {
+    'postcard_forms': ("org_name", "dba_name_1 || ' ' || dba_name_2 || ' ' || dba_name_3", "''"),
+    'irs_revocations': ("org_name", "alt_name", "''"),
+    'nine_nineties': ("org_name", "org_name_2", "mission"),
+    'pub_seven_data': ("org_name", "''", "''"),
+}
+
+#bm25 column weights for org_search: a hit in the name counts
+#for more than a hit in an alternate name or the mission
+SEARCH_WEIGHTS = (10.0, 4.0, 1.0)
+
+#PRAGMAs for the read-only connections used to look nonprofits up
+READ_PRAGMAS = {"mmap_size": 268435456, #map up to 256MB of the file
+                "cache_size": -64000, #~64MB page cache per connection
+                "temp_store": "MEMORY"}
+
+#Set IRS_DB_IMMUTABLE=1 when the database file won't change while the app
+#runs; sqlite3 then skips file locking entirely.
+IMMUTABLE = os.environ.get("IRS_DB_IMMUTABLE", "") == "1"
+
+#Idle connections kept for reuse, as (db, immutable): (identity of the
+#file they were opened on, queue of connections)
+POOL_SIZE = 8
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def open_connection(db, immutable=False):
+    '''
+    Opens a read-only connection to the database, with READ_PRAGMAS
+    applied, the clean_zip function registered, and rows returned as
+    sqlite3.Row. Fails if the database doesn't exist.
+    '''
+    uri = "file:" + urllib.parse.quote(os.path.abspath(db)) + "?mode=ro"
+    if immutable:
+        uri += "&immutable=1"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    for name, value in READ_PRAGMAS.items():
+        conn.execute("PRAGMA " + name + " = " + str(value) + ";")
+    conn.create_function('clean_zip', 1, clean_zip_codes)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def file_identity(db):
+    '''
+    Returns what tells one version of the database file from the next:
+    its inode, modification time and size, or None if it doesn't exist.
+    '''
+    try:
+        stat = os.stat(db)
+    except OSError:
+        return None
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def get_pool(db, immutable):
+    '''
+    Returns the queue of idle connections to the database. The pool is
+    replaced, and its idle connections closed, when the file has changed
+    since they were opened, e.g., create_database.py rebuilt it; those
+    connections would still read the old (possibly deleted) file.
+    '''
+    identity = file_identity(db)
+    with _POOLS_LOCK:
+        opened_on, pool = _POOLS.get((db, immutable), (None, None))
+        if pool is not None and opened_on == identity:
+            return pool
+        _POOLS[(db, immutable)] = (identity, queue.LifoQueue())
+    if pool is not None:
+        close_idle(pool)
+    return _POOLS[(db, immutable)][1]
+
+def close_idle(pool):
+    '''
+    Closes the idle connections in a pool.
+    '''
+    while True:
+        try:
+            pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+@contextlib.contextmanager
+def pooled_connection(db, immutable=None):
+    '''
+    Lends out a read-only connection to the database from this process's
+    pool, opening one if none is free, and takes it back afterwards.
+    Each connection is used by one thread at a time.
+    Inputs: db: database file
+            immutable: open with immutable=1. If none, uses IMMUTABLE.
+    '''
+    if immutable is None:
+        immutable = IMMUTABLE
+    pool = get_pool(db, immutable)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = open_connection(db, immutable)
+
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        #connections lent out before the file changed aren't reused
+        if pool.qsize() < POOL_SIZE and _POOLS.get((db, immutable), (None, None))[1] is pool:
+            pool.put(conn)
+        else:
+            conn.close()
+
+def close_pools():
+    '''
+    Closes every idle pooled connection. Pools already close their
+    connections once the database file changes, see get_pool.
+    '''
+    with _POOLS_LOCK:
+        pools = [pool for _, pool in _POOLS.values()]
+        _POOLS.clear()
+    for pool in pools:
+        close_idle(pool)
+
+@metrics.timed("sqlite.get_location")
 def get_location(db, nonprofit_name, ein_search=False):
     '''
-    Connects to database and returns data on a given nonprofit.
+    Returns data on a given nonprofit, using a pooled connection to the database.
+    Uses a single indexed lookup in the organizations table when it has the
+    nonprofit; otherwise searches each source table in turn.
     '''
-    with sqlite3.connect(db) as conn:
-        conn.create_function('clean_zip', 1, clean_zip_codes)
-        conn.row_factory = sqlite3.Row
+    with pooled_connection(db) as conn:
         c = conn.cursor()
+        if table_exists(conn, 'organizations'):
+            info = get_organizations(c, nonprofit_name, ein_search)
+            if info:
+                return (info, info[0].pop('nonprofits'))
+
         #c.execute("SELECT * FROM ", nonprofit)
         # Put in a while loop here to search through more than one table?
         for table in ZIP_TABLES:
-            query = "SELECT " + get_nonprofit_query(table) + " FROM " + table + " WHERE " + get_query_conditional(None, ein_search, False) + " COLLATE NOCASE;"
+            query = "SELECT " + get_nonprofit_query(table) + " FROM " + table + " WHERE " + get_query_conditional(None, ein_search, False) + ";"
 
             r = c.execute(query, (nonprofit_name, ))
 
@@ -25,22 +210,99 @@ def get_location(db, nonprofit_name, ein_search=False):
             results = r.fetchall()
             info = [dict(row) for row in results]
 
+            if results and table_exists(conn, 'organizations'):
+                #matched an alternate name; show the merged organizations
+                eins = list(dict.fromkeys(row['EIN'] for row in info))
+                merged = [org for ein in eins for org in get_organizations(c, ein, True)]
+                if merged:
+                    return (merged, merged[0].pop('nonprofits'))
             if results:
+                if table_exists(conn, 'zip_counts'):
+                    return (info, get_area_count(c, info[0]))
+                #databases built before area counts existed
                 n = c.execute("SELECT COUNT(*) FROM " + table + " WHERE " + get_query_conditional(table, False, True), get_query_count(table, info[0]))
                 count = n.fetchall()
                 # print("database_functions.get_location.count:", count)
                 return (info, count[0][0])
         return (None, None)
         
+def get_organizations(c, nonprofit_name, ein_search=False):
+    '''
+    Looks up nonprofits in the organizations table by EIN or name, along
+    with the number of nonprofits in their zip code (or city and state).
+    Returns a list of dictionaries, empty if nothing matched.
+    '''
+    query = ("SELECT o.*, COALESCE(z.nonprofits, t.nonprofits, 0) AS nonprofits FROM organizations o "
+             "LEFT JOIN zip_counts z ON z.zip5 = o.zip5 AND z.source = 'all' "
+             "LEFT JOIN city_counts t ON t.city = o.city AND t.state = o.state AND t.source = 'all' "
+             "WHERE o." + get_query_conditional(None, ein_search, False) + ";")
+    return [dict(row) for row in c.execute(query, (nonprofit_name, ))]
+
+def clean_ein(ein):
+    '''
+    Returns an EIN as stored in the database: nine digits, without the
+    dash, e.g., '01-2345678' or 12345678 becomes '012345678'. Returns
+    None if ein isn't one: anything but 1 to 9 digits, dashes and spaces.
+    '''
+    digits = re.sub(r"[\s-]", "", str(ein))
+    if not re.fullmatch(r"\d{1,9}", digits):
+        return None
+    return digits.zfill(9)
+
+def resolve_batch(db, keys, ein_search=True):
+    '''
+    Looks up many nonprofits at once by EIN or name. The keys are
+    loaded into a temporary table and joined to the organizations
+    table in one query, rather than one query per key. Results are
+    generated as they are read, so they can be streamed.
+    Inputs: db: database file
+            keys: list of EINs (as clean_ein returns them, None matching
+                nothing) or names
+            ein_search: True if the keys are EINs, False if names. Names
+                are matched against the organizations' names only, not
+                older names in the source tables as get_location does.
+    Returns: generator of (key, list of dictionaries), one per key in
+        order, each match as get_location returns it, along with the
+        number of nonprofits in its area
+    '''
+    with pooled_connection(db) as conn:
+        if not table_exists(conn, 'organizations'):
+            #databases built before the organizations table existed
+            for key in keys:
+                info, count = get_location(db, key, ein_search)
+                yield key, [dict(row, nonprofits=count) for row in info or []]
+            return
+
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS batch_keys (position INTEGER PRIMARY KEY, key TEXT);")
+        #the rows go away when the pooled connection is rolled back
+        conn.execute("DELETE FROM temp.batch_keys;")
+        conn.executemany("INSERT INTO temp.batch_keys VALUES (?, ?);", enumerate(keys))
+        match = "o.EIN = b.key" if ein_search else "o.org_name = b.key COLLATE NOCASE"
+        query = ("SELECT b.position, o.*, COALESCE(z.nonprofits, t.nonprofits, 0) AS nonprofits "
+                 "FROM temp.batch_keys b LEFT JOIN organizations o ON " + match + " "
+                 "LEFT JOIN zip_counts z ON z.zip5 = o.zip5 AND z.source = 'all' "
+                 "LEFT JOIN city_counts t ON t.city = o.city AND t.state = o.state AND t.source = 'all' "
+                 "ORDER BY b.position;")
+
+        position, matches = 0, []
+        for row in conn.execute(query):
+            if row['position'] != position:
+                yield keys[position], matches
+                position, matches = row['position'], []
+            if row['EIN'] is not None:
+                matches.append({key: row[key] for key in row.keys() if key != 'position'})
+        if keys:
+            yield keys[position], matches
+
 def get_nonprofit_query(table):
     '''
     Organizes fields to return based on table.
     '''
     if table == 'postcard_forms':
-        return ', '.join(['EIN', 'org_name', 'website', 'city', 'state', 'clean_zip(zip)'])
+        return ', '.join(['EIN', 'org_name', 'website', 'city', 'state', 'zip5'])
 
     elif table == 'irs_revocations':
-        return ', '.join(['EIN', 'org_name', 'city', 'state', 'clean_zip(zip)'])
+        return ', '.join(['EIN', 'org_name', 'city', 'state', 'zip5'])
 
     elif table == 'nine_nineties':
         return '*'
@@ -55,14 +317,30 @@ def get_query_conditional(table, ein_search, count):
     '''
     if count:
         if table != 'pub_seven_data':
-            return "zip = (?);"
+            return "zip5 = (?);"
         else:
             return "city = (?) AND state = (?)"
 
     if ein_search:
         return 'EIN = (?)'
     else:
-        return 'org_name = (?)'
+        #must match the collation of the org_name indexes
+        return 'org_name = (?) COLLATE NOCASE'
+
+def get_area_count(c, info):
+    '''
+    Looks up the precomputed number of nonprofits, across all source
+    tables, in the zip code of the given result, or in its city and
+    state when there is no zip.
+    '''
+    if info.get('zip5'):
+        r = c.execute("SELECT nonprofits FROM zip_counts WHERE zip5 = ? AND source = 'all';",
+                      (info['zip5'], ))
+    else:
+        r = c.execute("SELECT nonprofits FROM city_counts WHERE city = ? AND state = ? AND source = 'all';",
+                      (info.get('city'), info.get('state')))
+    row = r.fetchone()
+    return row[0] if row else 0
 
 def get_query_count(table, info):
     '''
@@ -70,10 +348,523 @@ def get_query_count(table, info):
     '''
     if table == 'pub_seven_data':
     	return (info['city'], info['state'])
-    elif table == "nine_nineties":
-    	return(info['zip'], )
     else:
-        return (info['clean_zip(zip)'], )
+        return (info['zip5'], )
+
+
+def table_exists(conn, table):
+    '''
+    Checks whether the database has a table with the given name.
+    '''
+    r = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (table, ))
+    return r.fetchone() is not None
+
+
+def get_columns(conn, table):
+    '''
+    Returns the list of column names in a table.
+    '''
+    return [row[1] for row in conn.execute("PRAGMA table_info(" + table + ");")]
+
+
+def add_zip5(conn, table):
+    '''
+    Adds the zip5 column to a table if needed and fills it in for any
+    rows that don't have it yet (e.g., rows loaded since the last build).
+    '''
+    if 'zip5' not in get_columns(conn, table):
+        conn.execute("ALTER TABLE " + table + " ADD COLUMN zip5;")
+    conn.execute("UPDATE " + table + " SET zip5 = substr(zip, 1, 5) WHERE zip5 IS NULL;")
+
+
+def build_indexes(conn, tables=None):
+    '''
+    Post-load phase: adds zip5 columns and creates the lookup indexes
+    in INDEXES. Safe to run again after reloading a table.
+    Inputs: conn: sqlite3 connection
+            tables: list of tables to index. If none, indexes all of them.
+    Returns: None
+    '''
+    for table in tables or INDEXES.keys():
+        if not table_exists(conn, table):
+            continue
+        with conn:
+            if table in ZIP5_TABLES:
+                add_zip5(conn, table)
+            for columns in INDEXES[table]:
+                name = "_".join([table] + [col.split()[0] for col in columns] + ["idx"])
+                conn.execute("CREATE INDEX IF NOT EXISTS " + name + " ON " + table +
+                             " (" + ", ".join(columns) + ");")
+        conn.execute("ANALYZE " + table + ";")
+
+
+def refresh_area_counts(conn, tables=None):
+    '''
+    Rebuilds the zip_counts and city_counts tables: the number of
+    nonprofits per zip5 and per city/state in each source table, plus
+    'all', the number of distinct EINs across every source table.
+    Run after build_indexes, as it relies on the zip5 columns.
+    Inputs: conn: sqlite3 connection
+            tables: list of source tables that were (re)loaded. If none,
+                recounts all of them. 'all' is always recounted.
+    Returns: None
+    '''
+    present = [table for table in ZIP_TABLES if table_exists(conn, table)]
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS zip_counts (source, zip5, nonprofits, "
+                     "PRIMARY KEY (zip5, source));")
+        conn.execute("CREATE TABLE IF NOT EXISTS city_counts (source, city, state, nonprofits, "
+                     "PRIMARY KEY (city, state, source));")
+
+        for table in [t for t in present if t in (tables or ZIP_TABLES)]:
+            conn.execute("DELETE FROM zip_counts WHERE source = ?;", (table, ))
+            conn.execute("DELETE FROM city_counts WHERE source = ?;", (table, ))
+            if table in ZIP5_TABLES:
+                conn.execute("INSERT INTO zip_counts SELECT ?, zip5, COUNT(*) FROM " + table +
+                             " WHERE zip5 != '' GROUP BY zip5;", (table, ))
+            conn.execute("INSERT INTO city_counts SELECT ?, city, state, COUNT(*) FROM " + table +
+                         " WHERE city != '' GROUP BY city, state;", (table, ))
+
+        conn.execute("DELETE FROM zip_counts WHERE source = 'all';")
+        conn.execute("DELETE FROM city_counts WHERE source = 'all';")
+        zips = " UNION ALL ".join(["SELECT EIN, zip5 FROM " + t for t in present if t in ZIP5_TABLES])
+        if zips:
+            conn.execute("INSERT INTO zip_counts SELECT 'all', zip5, COUNT(DISTINCT EIN) FROM (" +
+                         zips + ") WHERE zip5 != '' GROUP BY zip5;")
+        cities = " UNION ALL ".join(["SELECT EIN, city, state FROM " + t for t in present])
+        if cities:
+            conn.execute("INSERT INTO city_counts SELECT 'all', city, state, COUNT(DISTINCT EIN) FROM (" +
+                         cities + ") WHERE city != '' GROUP BY city, state;")
+
+
+def organization_query(present, filings=True):
+    '''
+    Builds the SELECT that merges the source tables into organizations
+    rows, for the EINs in the temp table org_refresh.
+    Inputs:
+        present: list of source tables in the database
+        filings: whether the database has the financials table, to tell
+            which 990 is the latest. If not, any 990 of the EIN is used.
+    Returns:
+        query (str)
+    '''
+    aliases = {table: "s" + str(i) for i, table in enumerate(present)}
+    columns = []
+    for column, sources in ORGANIZATION_COLUMNS:
+        values = ["NULLIF(" + aliases[table] + "." + source + ", '')"
+                  for table, source in sources if table in aliases]
+        if len(values) > 1:
+            value = "COALESCE(" + ", ".join(values) + ")"
+        else:
+            value = values[0] if values else "NULL"
+        columns.append(value + " AS " + column)
+    if 'irs_revocations' in aliases:
+        alias = aliases['irs_revocations']
+        columns.append("CASE WHEN " + alias + ".EIN IS NOT NULL AND COALESCE(" + alias +
+                       ".date_renewed, '') = '' THEN 1 ELSE 0 END AS revoked")
+    else:
+        columns.append("0 AS revoked")
+    columns.append("trim(" + " || ".join("CASE WHEN " + alias + ".EIN IS NOT NULL THEN '" + table +
+                                          " ' ELSE '' END" for table, alias in aliases.items()) + ") AS sources")
+
+    joins = []
+    for table, alias in aliases.items():
+        if table == 'nine_nineties' and filings:
+            row = LATEST_FILING
+        else:
+            row = "SELECT rowid FROM " + table + " WHERE EIN = e.EIN " + ORGANIZATION_ROWS.get(table, "") + " LIMIT 1"
+        joins.append("LEFT JOIN " + table + " " + alias + " ON " + alias + ".rowid = (" + row + ")")
+    return ("SELECT e.EIN, " + ", ".join(columns) + " FROM org_refresh e " + " ".join(joins) +
+            " WHERE " + " OR ".join(alias + ".EIN IS NOT NULL" for alias in aliases.values()))
+
+
+def refresh_organizations(conn, tables=None, since=None):
+    '''
+    Builds or refreshes the organizations table: one row per EIN, merging
+    the best available name, address, website, mission, deductibility and
+    revocation status from every source table (see ORGANIZATION_COLUMNS).
+    Only the EINs in reloaded tables are rebuilt, so an incremental load
+    doesn't rebuild the whole table. Run after build_indexes. The EINs
+    it rebuilt are left in temp.org_refresh for build_search_index.
+    Inputs:
+        conn: sqlite3 connection
+        tables: list of source tables that were (re)loaded. If none, or
+            if there is no organizations table yet, rebuilds every EIN.
+        since: if given (as datetime('now') text), only the 990 forms
+            loaded since then are refreshed, rather than all of nine_nineties
+    Returns: None
+    '''
+    present = [table for table in ZIP_TABLES if table_exists(conn, table)]
+    if not present:
+        return
+    rebuild = tables is None or not table_exists(conn, 'organizations')
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS organizations (EIN TEXT PRIMARY KEY, " +
+                     ", ".join(column for column, _ in ORGANIZATION_COLUMNS) + ", revoked, sources);")
+        conn.execute("CREATE INDEX IF NOT EXISTS organizations_org_name_idx ON organizations "
+                     "(org_name COLLATE NOCASE);")
+        conn.execute("CREATE INDEX IF NOT EXISTS organizations_zip5_idx ON organizations (zip5);")
+        conn.execute("DROP TABLE IF EXISTS temp.org_refresh;")
+        conn.execute("CREATE TEMP TABLE org_refresh (EIN TEXT PRIMARY KEY);")
+        if rebuild:
+            conn.execute("DELETE FROM organizations;")
+            changed = present
+        else:
+            changed = [table for table in present if table in tables]
+        for table in changed:
+            if table == 'nine_nineties' and since and not rebuild:
+                conn.execute("INSERT OR IGNORE INTO org_refresh SELECT EIN FROM nine_nineties WHERE rowid IN "
+                             "(SELECT row_id FROM load_manifest WHERE loaded_at >= ?);", (since, ))
+                continue
+            conn.execute("INSERT OR IGNORE INTO org_refresh SELECT EIN FROM " + table + " WHERE EIN != '';")
+            if not rebuild:
+                #EINs that are no longer in the table
+                conn.execute("INSERT OR IGNORE INTO org_refresh SELECT EIN FROM organizations "
+                             "WHERE ' ' || sources || ' ' LIKE ?;", ('% ' + table + ' %', ))
+        conn.execute("DELETE FROM organizations WHERE EIN IN (SELECT EIN FROM org_refresh);")
+        conn.execute("INSERT INTO organizations " + organization_query(present, table_exists(conn, 'financials')) + ";")
+    conn.execute("ANALYZE organizations;")
+
+
+def stamp_build(conn):
+    '''
+    Records a new build version, and when it was built, in the
+    build_info table, so caches of lookups in the old database (see
+    page_cache.py) know to stop using them. Run after every load.
+    '''
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS build_info (key TEXT PRIMARY KEY, value TEXT);")
+        conn.execute("INSERT OR REPLACE INTO build_info VALUES ('version', ?);", (os.urandom(8).hex(), ))
+        conn.execute("INSERT OR REPLACE INTO build_info VALUES ('built_at', datetime('now'));")
+
+
+@metrics.timed("sqlite.build_info")
+def build_info(db):
+    '''
+    Returns the build version of the database, and when it was built
+    (a UTC datetime), from the build_info table. Databases built before
+    it existed use the file's inode, modification time and size instead.
+    Read through pooled_connection, which reopens its connections when
+    the file is replaced, so a full rebuild gives a new version too.
+    '''
+    with pooled_connection(db) as conn:
+        if table_exists(conn, 'build_info'):
+            info = dict(tuple(row) for row in conn.execute("SELECT key, value FROM build_info;"))
+            built_at = datetime.datetime.strptime(info['built_at'], "%Y-%m-%d %H:%M:%S")
+            return info['version'], built_at.replace(tzinfo=datetime.timezone.utc)
+    stat = os.stat(db)
+    built_at = datetime.datetime.fromtimestamp(int(stat.st_mtime), datetime.timezone.utc)
+    return "%x-%x-%x" % (stat.st_ino, stat.st_mtime_ns, stat.st_size), built_at
+
+
+def search_query(table, where=""):
+    '''
+    Returns the query inserting a source table's rows (those matching
+    where, if given) into org_search; its parameter is the table's name.
+    '''
+    name, alt_names, mission = SEARCH_COLUMNS[table]
+    return ("INSERT INTO org_search SELECT COALESCE(" + name + ", ''), COALESCE(" + alt_names +
+            ", ''), COALESCE(" + mission + ", ''), EIN, city, state, ? FROM " + table + where + ";")
+
+
+def build_search_index(conn, tables=None):
+    '''
+    Builds or refreshes org_search, an FTS5 full-text index over nonprofit
+    names, alternate (dba) names and 990 missions from every source table.
+    Requires sqlite3 to be built with FTS5.
+    Inputs: conn: sqlite3 connection
+            tables: list of source tables that were (re)loaded. If given,
+                only the rows of the EINs refresh_organizations just rebuilt
+                (temp.org_refresh) are indexed again. If none, or if there
+                is no org_search table yet, rebuilds the whole index.
+    Returns: None
+    '''
+    refresh = conn.execute("SELECT 1 FROM sqlite_temp_master WHERE type = 'table' "
+                           "AND name = 'org_refresh';").fetchone()
+    if tables is not None and refresh and table_exists(conn, 'org_search'):
+        with conn:
+            conn.execute("DELETE FROM org_search WHERE EIN IN (SELECT EIN FROM temp.org_refresh);")
+            for table in ZIP_TABLES:
+                if not table_exists(conn, table):
+                    continue
+                conn.execute(search_query(table, " WHERE EIN IN (SELECT EIN FROM temp.org_refresh)"), (table, ))
+        return
+
+    with conn:
+        conn.execute("DROP TABLE IF EXISTS org_search;")
+        conn.execute("CREATE VIRTUAL TABLE org_search USING fts5(org_name, alt_names, mission, "
+                     "EIN UNINDEXED, city UNINDEXED, state UNINDEXED, source UNINDEXED, "
+                     "prefix = '2 3');")
+        for table in ZIP_TABLES:
+            if not table_exists(conn, table):
+                continue
+            conn.execute(search_query(table), (table, ))
+        conn.execute("INSERT INTO org_search (org_search) VALUES ('optimize');")
+
+
+@metrics.timed("sqlite.search_names")
+def search_names(db, text, limit=10):
+    '''
+    Ranked full-text search for nonprofits by name. Every word is
+    matched as a prefix, so partial names work. If that finds nothing,
+    falls back to a fuzzy search: any word may match on its first few
+    letters, and the candidates are reranked by how similar their
+    name is to the search text.
+    Inputs: db: database file
+            text: search text
+            limit: number of results (int)
+    Returns: list of dictionaries (EIN, org_name, city, state, source),
+        best match first, one per EIN
+    '''
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return []
+
+    with pooled_connection(db) as conn:
+        if not table_exists(conn, 'org_search'):
+            return []
+        query = ("SELECT EIN, org_name, city, state, source FROM org_search WHERE org_search MATCH ? "
+                 "ORDER BY bm25(org_search, " + ", ".join(str(w) for w in SEARCH_WEIGHTS) + ") LIMIT ?;")
+
+        exact = " ".join('"' + word + '"*' for word in words)
+        results = [dict(row) for row in conn.execute(query, (exact, limit * 5))]
+        if not results:
+            fuzzy = " OR ".join('"' + word[:3] + '"*' for word in words)
+            candidates = [dict(row) for row in conn.execute(query, (fuzzy, 200))]
+            text = " ".join(words)
+            results = sorted(candidates, reverse=True, key=lambda row:
+                             difflib.SequenceMatcher(None, text, row['org_name'].lower()).ratio())
+
+    matches = []
+    seen = set()
+    for row in results:
+        if row['EIN'] not in seen:
+            seen.add(row['EIN'])
+            matches.append(row)
+    return matches[:limit]
+
+
+#Columns of the financials table that identify a filing rather than
+#hold one of its numeric fields
+FILING_COLUMNS = ('EIN', 'tax_year', 'tax_period', 'return_type', 'object_id', 'filing_id')
+
+
+def financial_column(conn, column):
+    '''
+    Checks that column is one of the numeric columns of the financials
+    table (built by create_database.py), so it can be put in a query.
+    '''
+    if column in FILING_COLUMNS or column not in get_columns(conn, 'financials'):
+        raise ValueError("Not a column of the financials table: " + str(column))
+    return column
+
+
+def financial_values(db, column, missingdata=False, tax_year=None):
+    '''
+    Returns one numeric 990 field for every filing, e.g., total_revenue,
+    as a NumPy array.
+    Inputs:
+        db: database name
+        column: column of the financials table
+        missingdata: Boolean. If true, filings without a
+        value count as 0; if false, they are left out.
+        tax_year: if given, only filings for that tax year (int)
+    Returns:
+        NumPy array of int64
+    '''
+    with pooled_connection(db) as conn:
+        column = financial_column(conn, column)
+        value = "COALESCE(" + column + ", 0)" if missingdata else column
+        query = "SELECT " + value + " FROM financials"
+        conditions = [] if missingdata else [column + " IS NOT NULL"]
+        params = ()
+        if tax_year is not None:
+            conditions.append("tax_year = (?)")
+            params = (tax_year, )
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        rows = conn.execute(query + ";", params)
+        return np.fromiter((row[0] for row in rows), dtype=np.int64)
+
+
+def financial_average(db, column, missingdata=False, tax_year=None):
+    '''
+    Returns the average of a numeric 990 field across filings, computed
+    by sqlite3. Same inputs as financial_values. Returns None if there
+    are no values.
+    '''
+    with pooled_connection(db) as conn:
+        column = financial_column(conn, column)
+        value = "COALESCE(" + column + ", 0)" if missingdata else column
+        query = "SELECT AVG(" + value + ") FROM financials"
+        params = ()
+        if tax_year is not None:
+            query += " WHERE tax_year = (?)"
+            params = (tax_year, )
+        return conn.execute(query + ";", params).fetchone()[0]
+
+
+def financial_quantiles(db, column, quantiles, missingdata=False, tax_year=None):
+    '''
+    Returns list of tuples (quantile, value) for a numeric 990 field.
+    Inputs:
+        db, column, missingdata, tax_year: as for financial_values
+        quantiles: list of percentiles, e.g., [0,.25, .5, .75, 1]
+    '''
+    values = financial_values(db, column, missingdata, tax_year)
+    if not len(values):
+        return [(q, None) for q in quantiles]
+    return list(zip(quantiles, np.quantile(values, quantiles)))
+
+
+def highest_financials(db, column, num_vals, tax_year=None):
+    '''
+    Returns the filings with the highest values of a numeric 990 field,
+    e.g., to examine seemingly abnormally high values.
+    Inputs:
+        db: database name
+        column: column of the financials table
+        num_vals: number of filings wanted (int)
+        tax_year: if given, only filings for that tax year (int)
+    Returns:
+        list of dictionaries of EIN, tax_year and the column, highest first
+    '''
+    with pooled_connection(db) as conn:
+        column = financial_column(conn, column)
+        query = ("SELECT EIN, tax_year, " + column + " FROM financials WHERE "
+                 + column + " IS NOT NULL")
+        params = ()
+        if tax_year is not None:
+            query += " AND tax_year = (?)"
+            params = (tax_year, )
+        query += " ORDER BY " + column + " DESC LIMIT (?);"
+        return [dict(row) for row in conn.execute(query, params + (num_vals, ))]
+
+
+def financial_history(db, ein, columns=None, first_year=None, last_year=None):
+    '''
+    Returns an organization's 990 filings year by year, e.g., to chart
+    its revenue over time. Runs as one query on the financials table's
+    (EIN, tax_year) key, so only that organization's filings are read.
+    Inputs:
+        db: database name
+        ein: EIN of the organization
+        columns: list of numeric columns wanted. If none, all of them.
+        first_year, last_year: if given, the range of tax years (int)
+    Returns:
+        list of dictionaries, one per tax year in order, of the tax year,
+        tax period, return type and object ID of the filing and the columns
+    '''
+    with pooled_connection(db) as conn:
+        if not table_exists(conn, 'financials'):
+            return []
+        if columns is None:
+            columns = [column for column in get_columns(conn, 'financials') if column not in FILING_COLUMNS]
+        columns = [financial_column(conn, column) for column in columns]
+        query = ("SELECT " + ", ".join(['tax_year', 'tax_period', 'return_type', 'object_id'] + columns)
+                 + " FROM financials WHERE EIN = (?)")
+        params = [ein]
+        if first_year is not None:
+            query += " AND tax_year >= (?)"
+            params.append(first_year)
+        if last_year is not None:
+            query += " AND tax_year <= (?)"
+            params.append(last_year)
+        return [dict(row) for row in conn.execute(query + " ORDER BY tax_year;", params)]
+
+
+#Long labels of 990 fields filter_filings accepts in place of column names
+FILING_LABELS = dict([('Filer:EIN', 'EIN'), ('TaxYr', 'tax_year'),
+                      ('TaxPeriodEndDt', 'tax_period'), ('ReturnTypeCd', 'return_type'),
+                      ('Filer:BusinessName:BusinessNameLine1Txt', 'org_name'),
+                      ('Filer:USAddress:CityNm', 'city'),
+                      ('Filer:USAddress:StateAbbreviationCd', 'state'),
+                      ('Filer:USAddress:ZIPCd', 'zip'),
+                      ('IRS990:WebsiteAddressTxt', 'website')] +
+                     [(label, column) for column, label in read_xmls.NUMERIC_990_FIELDS.items()])
+
+
+def filing_columns(conn):
+    '''
+    Returns the columns filter_filings can filter on, as column name:
+    column in the query (financials f joined to the nine_nineties row
+    n of the same filing).
+    '''
+    columns = {column: "n." + column for column in get_columns(conn, 'nine_nineties')}
+    columns.update({column: "f." + column for column in get_columns(conn, 'financials')})
+    return columns
+
+
+def condition_sql(condition, columns):
+    '''
+    Turns a normalized filter condition (see read_xmls.normalize_condition)
+    into a WHERE clause, so sqlite3 can use its indexes to apply it.
+    Inputs:
+        condition: normalized condition, on column names or FILING_LABELS
+        columns: dictionary from filing_columns
+    Returns:
+        tuple of (SQL, list of parameters)
+    '''
+    if condition[0] in ('and', 'or'):
+        if not condition[1]:
+            return ("1" if condition[0] == 'and' else "0"), []
+        parts = [condition_sql(part, columns) for part in condition[1]]
+        sql = (" " + condition[0].upper() + " ").join("(" + part + ")" for part, _ in parts)
+        return sql, [param for _, params in parts for param in params]
+
+    tag, op, value = condition
+    column = columns.get(FILING_LABELS.get(tag, tag))
+    if column is None:
+        raise ValueError("Can't filter the database on: " + str(tag))
+    values = list(value) if op in ('in', 'not in', 'between') else [value]
+    #nine_nineties columns are untyped, so numbers are compared as numbers
+    if column.startswith("n.") and any(isinstance(v, (int, float)) and not isinstance(v, bool)
+                                       for v in values):
+        column = "CAST(" + column + " AS REAL)"
+    if op in ('in', 'not in'):
+        if not values:
+            return ("0" if op == 'in' else "1"), []
+        sql = column + (" IN (" if op == 'in' else " NOT IN (") + ", ".join(["?"] * len(values)) + ")"
+    elif op == 'between':
+        sql = column + " BETWEEN ? AND ?"
+    else:
+        sql = column + " " + ("=" if op == '==' else op) + " ?"
+    #as in read_xmls.compare, a missing value only matches != and not in
+    if op in ('!=', 'not in'):
+        sql = "(" + sql + " OR " + column + " IS NULL)"
+    return sql, values
+
+
+def filter_filings(db, condition, limit=None):
+    '''
+    Selects the 990 filings that meet a filter condition, e.g., all
+    filers in IL with revenue over $1M:
+        filter_filings(db, ('and', [('state', '==', 'IL'),
+                                    ('total_revenue', '>', 1000000)]))
+    The condition is the same as for read_xmls.filter_tree (see
+    read_xmls.normalize_condition), on the columns of the financials
+    and nine_nineties tables or the long labels in FILING_LABELS, and
+    runs as one SQL query.
+    Inputs:
+        db: database name
+        condition: filter condition
+        limit: maximum number of filings returned (int)
+    Returns:
+        list of dictionaries, one per filing (EIN and tax year), of its
+        name and location and the financials columns
+    '''
+    with pooled_connection(db) as conn:
+        if not (table_exists(conn, 'financials') and table_exists(conn, 'nine_nineties')):
+            return []
+        columns = filing_columns(conn)
+        where, params = condition_sql(read_xmls.normalize_condition(condition), columns)
+        query = ("SELECT f.*, n.org_name, n.city, n.state, n.zip FROM nine_nineties n "
+                 "JOIN financials f ON f.filing_id = n.rowid WHERE " + where +
+                 " ORDER BY f.EIN, f.tax_year")
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return [dict(row) for row in conn.execute(query + ";", params)]
 
 
 def clean_zip_codes(zip_code):
@@ -5,7 +5,10 @@ https://www.irs.gov/charities-non-profits/tax-exempt-organization-search-bulk-da
 
 '''
 import argparse
-import wget
+import concurrent.futures
+import json
+import requests
+import time
 import zipfile
 import os
 
@@ -16,38 +19,219 @@ parser = argparse.ArgumentParser(description='Accesses IRS Bulk Data Downloads p
                 the current working directory and accessed by create_database.py. No arguments needed. Note\
                 that the downloads are large; as such, this function may take a few minutes. A sample database\
                 is included for convenience.')
-
-args = parser.parse_args()
+parser.add_argument('-keep_zips', action='store_true', help='Keeps the downloaded zip files instead of\
+ 				extracting them. create_database.py reads the files straight out of the archives, which saves\
+ 				the disk space and time of unzipping the 990 forms.')
+parser.add_argument('-workers', type=int, default=4, help='Number of files downloaded, and threads\
+ 				unzipping, at once. Default is 4.')
+parser.add_argument('-retries', type=int, default=5, help='Number of times to retry a dropped download.\
+ 				Each retry resumes where the last one stopped. Default is 5.')
+parser.add_argument('-base_url', default=os.environ.get("IRS_DATA_URL", "https://apps.irs.gov/pub/epostcard/"),
+				help='Where to download the files from, e.g., a local mirror. Defaults to the IRS site\
+ 				(or the IRS_DATA_URL environment variable).')
 
 FOLDERS = {'data-download-pub78.zip':'IRS_Pub_78_Data',
 			'data-download-revocation.zip':'IRS_Revocations',
 			'data-download-epostcard.zip':'IRS_990N_FORMS',
 			'990AllXML.zip':'IRS_990_FORMS'}
 
-def get_irs_data():
+#Location of each file under the base url.
+LINKS = {'data-download-pub78.zip':'data-download-pub78.zip',
+			'data-download-revocation.zip':'data-download-revocation.zip',
+			'data-download-epostcard.zip':'data-download-epostcard.zip',
+			'990AllXML.zip':'990/990AllXML.zip'}
 
-	print("Downloading Publication 78 Data")
-	pub_seven = wget.download('https://apps.irs.gov/pub/epostcard/data-download-pub78.zip')
-	print("\nDownloading IRS Revocations Data")
-	irs_revocations = wget.download('https://apps.irs.gov/pub/epostcard/data-download-revocation.zip')
-	print("\nDownloading 990N Forms")
-	postcard_forms = wget.download('https://apps.irs.gov/pub/epostcard/data-download-epostcard.zip')
-	print("\nDownloading 990 Forms")
-	IRS_990_FORMS = wget.download("https://apps.irs.gov/pub/epostcard/990/990AllXML.zip")
+#Bytes read from the connection, and written, at a time.
+CHUNK_SIZE = 1 << 20
 
+#Seconds to wait for the server before retrying.
+TIMEOUT = 60
 
-	for file in FOLDERS.keys():
-		print("\nUnzipping " + file)
-		with zipfile.ZipFile(file,"r") as to_unpack:
-		    to_unpack.extractall(FOLDERS[file])
 
-	print("\nDeleting the zipped files.")
-	for file in FOLDERS.keys():
-		os.remove(file)
+def read_meta(file):
+	'''
+	Returns what was recorded about a download in its .meta file:
+	the ETag and Last-Modified headers the server sent with it.
+	Returns an empty dictionary if there is none.
+	'''
+	try:
+		with open(file + ".meta") as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
 
-	print("\nDone! Now create the database.")
+def write_meta(file, response):
+	'''
+	Records the ETag and Last-Modified headers of a download in its
+	.meta file, so later runs can ask the server whether it changed.
+	'''
+	meta = {"etag": response.headers.get("ETag"),
+			"last_modified": response.headers.get("Last-Modified"),
+			"url": response.url}
+	with open(file + ".meta", "w") as f:
+		json.dump(meta, f)
 
-if __name__ == "__main__":
-	get_irs_data()
+def verify_zip(file):
+	'''
+	Checks a downloaded archive by reading every member and comparing
+	its CRC. Returns True if the archive is complete and intact.
+	'''
+	if not zipfile.is_zipfile(file):
+		return False
+	try:
+		with zipfile.ZipFile(file) as archive:
+			return archive.testzip() is None
+	except (zipfile.BadZipFile, OSError, EOFError):
+		return False
+
+def download(file, url, retries=5):
+	'''
+	Downloads one file, streaming it to a .part file that is renamed
+	once the archive has been verified.
+	- If the file was downloaded before (and is still here, zipped or
+	extracted), the server is asked whether it has changed since, and
+	nothing is downloaded if it hasn't.
+	- A dropped connection is retried up to retries times, each time
+	resuming from the end of the .part file with an HTTP Range request.
+	A .part file left by an earlier run is resumed the same way, unless
+	the file on the server has changed in between.
+	Inputs:
+		file: name to save the file as
+		url: where to download it from
+		retries: number of times to retry (int)
+	Returns:
+		True if a new copy was downloaded, False if it was unchanged
+	'''
+	part = file + ".part"
+	meta = read_meta(file)
+	part_meta = read_meta(part)
+	conditional = {}
+	if meta and (os.path.isfile(file) or os.path.isdir(FOLDERS.get(file, file))):
+		if meta.get("etag"):
+			conditional["If-None-Match"] = meta["etag"]
+		if meta.get("last_modified"):
+			conditional["If-Modified-Since"] = meta["last_modified"]
+
+	attempt = 0
+	while True:
+		headers = dict(conditional)
+		done = os.path.getsize(part) if os.path.isfile(part) else 0
+		if done:
+			headers["Range"] = "bytes=" + str(done) + "-"
+			#only resume if the file is the one the .part file started from
+			validator = part_meta.get("etag") or part_meta.get("last_modified")
+			if validator:
+				headers["If-Range"] = validator
+		try:
+			with requests.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+				if response.status_code == 304:
+					print(file + " is unchanged since it was last downloaded.")
+					return False
+				if response.status_code == 416:
+					#the .part file is already complete
+					pass
+				else:
+					response.raise_for_status()
+					mode = "ab" if response.status_code == 206 else "wb"
+					if mode == "wb":
+						write_meta(part, response)
+						part_meta = read_meta(part)
+					with open(part, mode) as f:
+						for chunk in response.iter_content(CHUNK_SIZE):
+							f.write(chunk)
+			if not verify_zip(part):
+				#a corrupt download can't be resumed; start it over
+				os.remove(part)
+				raise IOError(file + " failed verification.")
+			if os.path.isfile(part + ".meta"):
+				os.replace(part + ".meta", file + ".meta")
+			os.replace(part, file)
+			print("Downloaded " + file)
+			return True
+		except (requests.RequestException, IOError) as e:
+			attempt += 1
+			if attempt > retries:
+				raise
+			print("Retrying " + file + " (" + str(e) + ")")
+			time.sleep(min(2 ** attempt, 30))
+
+def extract_members(file, folder, members):
+	'''
+	Extracts the given members of an archive into folder, using its
+	own handle to the archive so several can run at once.
+	'''
+	with zipfile.ZipFile(file) as archive:
+		for member in members:
+			archive.extract(member, folder)
+
+def make_folders(folder, members):
+	'''
+	Creates folder and every folder the members of an archive are
+	extracted into, dropping the parts of their paths zipfile drops
+	('..', '.' and empty ones).
+	'''
+	folders = set([folder])
+	for member in members:
+		parts = [part for part in os.path.dirname(member).split("/") if part not in ("", ".", "..")]
+		folders.add(os.path.join(folder, *parts))
+	for path in sorted(folders):
+		os.makedirs(path, exist_ok=True)
 
+def unzip(files, workers=4):
+	'''
+	Extracts each archive into its folder from FOLDERS. The members
+	of every archive are split across a pool of threads, so the large
+	990 archive is extracted in parallel too.
+	Inputs:
+		files: list of archives to extract
+		workers: number of threads (int)
+	'''
+	with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+		jobs = []
+		for file in files:
+			print("\nUnzipping " + file)
+			with zipfile.ZipFile(file) as archive:
+				members = archive.namelist()
+			#zipfile checks for a member's folders and then creates them,
+			#so threads extracting at once race to create the same one
+			make_folders(FOLDERS[file], members)
+			for i in range(workers):
+				jobs.append(pool.submit(extract_members, file, FOLDERS[file], members[i::workers]))
+		for job in concurrent.futures.as_completed(jobs):
+			job.result()
 
+def get_irs_data(keep_zips=False, workers=4, retries=5, base_url="https://apps.irs.gov/pub/epostcard/"):
+	'''
+	Downloads the four IRS files at once and unzips the ones that are
+	new or changed. Running it again only downloads what the IRS has
+	updated since, and picks up interrupted downloads where they stopped.
+	Inputs:
+		keep_zips: if True, leaves the archives zipped
+		workers: number of files downloaded, and threads unzipping, at once
+		retries: number of times to retry a dropped download
+		base_url: where to download the files from
+	'''
+	print("Downloading Publication 78 Data, IRS Revocations Data, 990N Forms and 990 Forms")
+	with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+		jobs = {file: pool.submit(download, file, base_url.rstrip("/") + "/" + LINKS[file], retries)
+				for file in FOLDERS.keys()}
+		changed = [file for file, job in jobs.items() if job.result()]
+
+	if keep_zips:
+		print("\nDone! Now create the database; the zip files are read as they are.")
+		return
+
+	#also extract archives kept by an earlier -keep_zips run
+	to_unzip = [file for file in FOLDERS.keys() if os.path.isfile(file)
+				and (file in changed or not os.path.isdir(FOLDERS[file]))]
+	if to_unzip:
+		unzip(to_unzip, workers)
+		print("\nDeleting the zipped files.")
+		for file in to_unzip:
+			os.remove(file)
+
+	print("\nDone! Now create the database.")
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+	get_irs_data(args.keep_zips, args.workers, args.retries, args.base_url)
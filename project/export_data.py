@@ -0,0 +1,215 @@
+'''
+***** EXPORT THE IRS DATABASE TO PARQUET *******
+Writes each IRS table to a folder of Parquet files, partitioned by
+state (e.g., export/pub_seven_data/state=IL/part-0.parquet), with
+typed columns, including the numeric 990 fields in financials. The
+folders can be read by pandas.read_parquet, pyarrow.dataset, DuckDB,
+Spark, etc. Used by create_database.py -export, or run on its own.
+'''
+import pyarrow as pa
+import pyarrow.parquet as pq
+import argparse
+import datetime
+import os
+import re
+import shutil
+import sqlite3
+import read_xmls
+import database_functions
+
+EXPORT_TABLES = ['pub_seven_data', 'nine_nineties', 'postcard_forms', 'irs_revocations']
+
+#Tables are split into one folder per value of this column
+PARTITION_COLUMN = 'state'
+
+#Partition of rows without a state (e.g., foreign addresses). Not the
+#hive null partition, which readers can't type when it is the only one.
+NULL_PARTITION = 'unknown'
+
+#Rows written to a partition's file at a time
+BATCH_SIZE = 50000
+
+#Table of the numeric 990 fields filled by create_database.py. It has
+#no state, so it is exported with the state on the same filing.
+FINANCIALS_TABLE = 'financials'
+FINANCIALS_QUERY = ("SELECT financials.*, (SELECT state FROM nine_nineties WHERE "
+                    "nine_nineties.rowid = financials.filing_id) AS state FROM financials;")
+
+
+def to_int(value):
+    '''
+    Returns value as an int, or None if it is blank or not a number.
+    '''
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_flag(value):
+    '''
+    Returns True or False for the IRS's 'T' / 'F' flags, otherwise None.
+    '''
+    return {'T': True, 'F': False}.get(value)
+
+def to_date(date_format):
+    '''
+    Returns a function that parses dates written in date_format,
+    returning None for blank or malformed dates.
+    '''
+    def parse(value):
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except (TypeError, ValueError):
+            return None
+    return parse
+
+#Typed columns, as table: {column: (arrow type, function converting the
+#sqlite value)}. Columns not listed are exported as strings. EINs and zip
+#codes stay strings to keep their leading zeros.
+COLUMN_TYPES = {
+    'postcard_forms': {'year': (pa.int16(), to_int),
+                       'small_org_status': (pa.bool_(), to_flag),
+                       'termination_status': (pa.bool_(), to_flag),
+                       'fiscal_year_start': (pa.date32(), to_date('%m/%d/%Y')),
+                       'fiscal_year_end': (pa.date32(), to_date('%m/%d/%Y'))},
+    'irs_revocations': {'date_expired': (pa.date32(), to_date('%d-%b-%Y')),
+                        'date_posted': (pa.date32(), to_date('%d-%b-%Y')),
+                        'date_renewed': (pa.date32(), to_date('%d-%b-%Y'))},
+    FINANCIALS_TABLE: dict([('tax_year', (pa.int16(), to_int)), ('filing_id', (pa.int64(), to_int)),
+                            ('tax_period', (pa.date32(), to_date('%Y-%m-%d')))] +
+                           [(column, (pa.int64(), to_int)) for column in read_xmls.NUMERIC_990_FIELDS]),
+}
+
+
+def export_schema(table, columns):
+    '''
+    Returns the arrow schema of the exported table, and the list of
+    converters for its columns (None where the value is kept as is).
+    '''
+    types = COLUMN_TYPES.get(table, {})
+    fields = []
+    converters = []
+    for column in columns:
+        arrow_type, converter = types.get(column, (pa.string(), None))
+        fields.append(pa.field(column, arrow_type))
+        converters.append(converter)
+    return pa.schema(fields), converters
+
+def partition_name(value):
+    '''
+    Returns the partition folder name for a state, e.g., 'state=IL'.
+    '''
+    value = re.sub(r'[^A-Za-z0-9_-]', '', value or '')
+    return PARTITION_COLUMN + "=" + (value or NULL_PARTITION)
+
+def write_partitioned(rows, folder, table, columns, batch_size=BATCH_SIZE):
+    '''
+    Writes rows to Parquet files in folder, one file per state. The
+    state column is stored in the folder name rather than the files.
+    Rows are buffered per state and written batch_size at a time, so
+    the whole table is never held in memory.
+    Inputs:
+        rows: iterable of row tuples, in the order of columns
+        folder: folder to write into; replaced if it exists
+        table: table name, for COLUMN_TYPES
+        columns: list of column names, including PARTITION_COLUMN
+        batch_size: rows per write (int)
+    Returns:
+        number of rows written
+    '''
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    partition = columns.index(PARTITION_COLUMN)
+    kept = [i for i in range(len(columns)) if i != partition]
+    schema, converters = export_schema(table, [columns[i] for i in kept])
+
+    writers = {}
+    buffers = {}
+
+    def flush(name):
+        data = list(zip(*buffers[name]))
+        arrays = []
+        for values, field, converter in zip(data, schema, converters):
+            if converter:
+                values = [converter(value) for value in values]
+            arrays.append(pa.array(values, type=field.type))
+        if name not in writers:
+            os.makedirs(os.path.join(folder, name))
+            writers[name] = pq.ParquetWriter(os.path.join(folder, name, "part-0.parquet"), schema)
+        writers[name].write_table(pa.Table.from_arrays(arrays, schema=schema))
+        buffers[name] = []
+
+    count = 0
+    for row in rows:
+        name = partition_name(row[partition])
+        buffers.setdefault(name, []).append([row[i] for i in kept])
+        if len(buffers[name]) >= batch_size:
+            flush(name)
+        count += 1
+    for name in buffers:
+        if buffers[name]:
+            flush(name)
+    for writer in writers.values():
+        writer.close()
+    return count
+
+def export_table(conn, table, export_dir, batch_size=BATCH_SIZE, query=None):
+    '''
+    Exports one table of the IRS database, reading it a batch at a time.
+    Inputs:
+        conn: sqlite3 connection
+        table: table name
+        export_dir: folder holding the exported tables
+        batch_size: rows read and written at a time (int)
+        query: if given, the SELECT statement to export instead of the
+            whole table. It must include the state column.
+    Returns:
+        number of rows exported
+    '''
+    cursor = conn.execute(query or "SELECT * FROM " + table + ";")
+    columns = [column[0] for column in cursor.description]
+
+    def rows():
+        while True:
+            chunk = cursor.fetchmany(batch_size)
+            if not chunk:
+                return
+            yield from chunk
+
+    return write_partitioned(rows(), os.path.join(export_dir, table), table, columns, batch_size)
+
+def export_database(conn, export_dir, tables=None, batch_size=BATCH_SIZE):
+    '''
+    Exports the IRS tables, and the numeric 990 fields in the
+    financials table, to Parquet.
+    Inputs:
+        conn: sqlite3 connection
+        export_dir: folder to write the tables into
+        tables: list of tables to export. If none, every table in EXPORT_TABLES.
+        batch_size: rows read and written at a time (int)
+    Returns:
+        dictionary of table name: number of rows exported
+    '''
+    counts = {}
+    for table in tables or EXPORT_TABLES:
+        if database_functions.table_exists(conn, table):
+            print("Exporting " + table)
+            counts[table] = export_table(conn, table, export_dir, batch_size)
+    if database_functions.table_exists(conn, FINANCIALS_TABLE):
+        print("Exporting " + FINANCIALS_TABLE)
+        counts[FINANCIALS_TABLE] = export_table(conn, FINANCIALS_TABLE, export_dir, batch_size,
+                                                FINANCIALS_QUERY)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Exports the tables of an IRS database built by \
+                                     create_database.py to Parquet files, partitioned by state.')
+    parser.add_argument('-database', help='Database to export, e.g., IRS_DATA.sqlite3')
+    parser.add_argument('-export_dir', default='export', help='Folder to write the Parquet files into.\
+                        Default is export.')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    print(export_database(conn, args.export_dir))
+    conn.close()
@@ -0,0 +1,188 @@
+'''
+***** LATENCY METRICS *******
+Times the stages of a request (sqlite3 lookups, ACS data, percentiles,
+graphs, template rendering) into one histogram per stage, served by the
+app at /metrics in the Prometheus text format. The stages of each
+request are also written to a log as one JSON object per line, and a
+request can be profiled with cProfile by adding ?profile=1 when
+PROFILE_DIR is set.
+'''
+import bisect
+import contextlib
+import cProfile
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+#Upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#File the JSON log lines are appended to. If not set, they go to stderr.
+LOG_FILE = os.environ.get("METRICS_LOG")
+
+#Folder profiles of ?profile=1 requests are saved in. If not set,
+#requests are never profiled.
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+
+#stage: [count per bucket, the last past BUCKETS; total seconds]
+_HISTOGRAMS = {}
+_LOCK = threading.Lock()
+
+#Seconds spent in each stage by the request this thread is serving
+_CURRENT = threading.local()
+
+#Only one profiler can run at a time
+_PROFILING = threading.Lock()
+
+LOG = logging.getLogger("metrics")
+
+
+def observe(stage, seconds):
+    '''
+    Records that a stage took seconds, in its histogram and in the
+    stages of the current request.
+    '''
+    with _LOCK:
+        histogram = _HISTOGRAMS.get(stage)
+        if histogram is None:
+            histogram = _HISTOGRAMS[stage] = [[0] * (len(BUCKETS) + 1), 0.0]
+        histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+    stages = getattr(_CURRENT, "stages", None)
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def timer(stage):
+    '''
+    Times the code in a with block as a stage.
+    '''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+
+def timed(stage):
+    '''
+    Decorator timing every call of a function as a stage.
+    '''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def start_request():
+    '''
+    Starts collecting the stages timed by this thread for a new request.
+    '''
+    _CURRENT.stages = {}
+
+
+def finish_request():
+    '''
+    Stops collecting stages for this thread's request and returns them,
+    as stage: seconds.
+    '''
+    stages = getattr(_CURRENT, "stages", None) or {}
+    _CURRENT.stages = None
+    return stages
+
+
+def setup_log(log_file=None):
+    '''
+    Sends the log lines to log_file (if none, LOG_FILE, or stderr),
+    one JSON object per line.
+    '''
+    log_file = log_file or LOG_FILE
+    handler = logging.FileHandler(log_file) if log_file else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    LOG.handlers = [handler]
+    LOG.setLevel(logging.INFO)
+    LOG.propagate = False
+
+
+def log_event(event, **fields):
+    '''
+    Writes one JSON log line of an event and its fields, with the time.
+    '''
+    fields.update(event=event, time=round(time.time(), 3))
+    LOG.info(json.dumps(fields, sort_keys=True, default=str))
+
+
+def start_profile():
+    '''
+    Starts profiling this thread with cProfile. Returns the profiler, or
+    None if profiling is off (no PROFILE_DIR) or another request is
+    being profiled.
+    '''
+    if not PROFILE_DIR or not _PROFILING.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        #another profiler or debugger is running
+        _PROFILING.release()
+        return None
+    return profiler
+
+
+def stop_profile(profiler, name):
+    '''
+    Stops a profiler from start_profile and saves its statistics in
+    PROFILE_DIR, for pstats or snakeviz. Returns the file name.
+    '''
+    try:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        file_name = time.strftime("%Y%m%d-%H%M%S-") + re.sub(r"\W+", "_", name).strip("_") + ".prof"
+        profiler.dump_stats(os.path.join(PROFILE_DIR, file_name))
+        return file_name
+    finally:
+        _PROFILING.release()
+
+
+def snapshot():
+    '''
+    Returns a copy of the histograms, as stage: (count per bucket, total
+    seconds).
+    '''
+    with _LOCK:
+        return {stage: (list(counts), total) for stage, (counts, total) in _HISTOGRAMS.items()}
+
+
+def prometheus_text():
+    '''
+    Returns the histograms in the Prometheus text format, as the
+    stage_seconds histogram with a stage label.
+    '''
+    lines = ["# HELP stage_seconds Time spent in each stage of a request.",
+             "# TYPE stage_seconds histogram"]
+    for stage, (counts, total) in sorted(snapshot().items()):
+        label = 'stage="' + stage.replace("\\", "\\\\").replace('"', '\\"') + '"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf", ), counts):
+            cumulative += count
+            lines.append("stage_seconds_bucket{" + label + ',le="' + str(bound) + '"} ' + str(cumulative))
+        lines.append("stage_seconds_sum{" + label + "} " + repr(total))
+        lines.append("stage_seconds_count{" + label + "} " + str(cumulative))
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    '''
+    Empties the histograms.
+    '''
+    with _LOCK:
+        _HISTOGRAMS.clear()
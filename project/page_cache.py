@@ -0,0 +1,127 @@
+'''
+***** CACHE OF LOOKUPS AND RENDERED PAGES *******
+Keeps the results of nonprofit lookups and the pages rendered from them
+in memory (least recently used first out, and for at most CACHE_TTL
+seconds), and optionally in a sqlite3 file shared by every app process.
+Keys include the database's build version (see
+database_functions.build_info), so a rebuilt or reloaded database is
+never answered from the old one's entries. Values must be JSON-ready.
+'''
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+
+#Entries kept in memory per process
+CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", 2000))
+
+#Seconds an entry is used for, even if the database hasn't changed
+CACHE_TTL = int(os.environ.get("PAGE_CACHE_TTL", 60 * 60))
+
+#sqlite3 file shared by the app's processes, e.g., several gunicorn
+#workers. If not set, each process only has its own memory cache.
+CACHE_DB = os.environ.get("PAGE_CACHE")
+
+#key: (time stored, value), least recently used first
+_MEMORY = collections.OrderedDict()
+_LOCK = threading.Lock()
+_DISK_READY = set()
+
+
+def cache_key(*parts):
+    '''
+    Returns the cache key for the parts of a lookup, e.g.,
+    cache_key("ein", version, ein).
+    '''
+    return json.dumps(parts)
+
+
+def open_disk():
+    '''
+    Opens the shared cache file, creating its table and dropping expired
+    entries the first time this process opens it. Returns None if there
+    is no shared cache.
+    '''
+    if not CACHE_DB:
+        return None
+    conn = sqlite3.connect(CACHE_DB, timeout=30)
+    if CACHE_DB not in _DISK_READY:
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS page_cache (key PRIMARY KEY, stored, value);")
+            conn.execute("DELETE FROM page_cache WHERE stored < ?;", (time.time() - CACHE_TTL, ))
+        _DISK_READY.add(CACHE_DB)
+    return conn
+
+
+def get(key):
+    '''
+    Returns (time stored, value) for a key, or None if it isn't cached
+    or has expired. Looks in memory first, then in the shared cache.
+    '''
+    now = time.time()
+    with _LOCK:
+        entry = _MEMORY.get(key)
+        if entry and now - entry[0] < CACHE_TTL:
+            _MEMORY.move_to_end(key)
+            return entry
+
+    conn = open_disk()
+    if conn is None:
+        return None
+    try:
+        row = conn.execute("SELECT stored, value FROM page_cache WHERE key = ?;", (key, )).fetchone()
+    finally:
+        conn.close()
+    if not row or now - row[0] >= CACHE_TTL:
+        return None
+    entry = (row[0], json.loads(row[1]))
+    remember(key, entry)
+    return entry
+
+
+def remember(key, entry):
+    '''
+    Puts an entry in the memory cache, dropping the least recently used
+    entries past CACHE_SIZE.
+    '''
+    with _LOCK:
+        _MEMORY[key] = entry
+        _MEMORY.move_to_end(key)
+        while len(_MEMORY) > CACHE_SIZE:
+            _MEMORY.popitem(last=False)
+
+
+def put(key, value):
+    '''
+    Caches a value in memory and in the shared cache.
+    Returns (time stored, value).
+    '''
+    entry = (time.time(), value)
+    remember(key, entry)
+    conn = open_disk()
+    if conn is not None:
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO page_cache VALUES (?, ?, ?);",
+                             (key, entry[0], json.dumps(value)))
+        finally:
+            conn.close()
+    return entry
+
+
+def cached(key, build):
+    '''
+    Returns (time stored, value) for a key, calling build() to get the
+    value if it isn't cached.
+    '''
+    return get(key) or put(key, build())
+
+
+def clear():
+    '''
+    Empties this process's memory cache.
+    '''
+    with _LOCK:
+        _MEMORY.clear()
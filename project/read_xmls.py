@@ -1,7 +1,26 @@
 import xml.etree.ElementTree as ET
 import matplotlib.pyplot as plt
 import numpy as np
+import multiprocessing as mp
+import functools
+import heapq
+import itertools
+import collections
+import operator
 import os
+import time
+import weakref
+import zipfile
+
+#Path indexes built by tree_index, as tree: (paths, leaves). Entries go
+#away with their trees (the index only holds a weak proxy of the tree's
+#root, or it would keep the tree alive); clean_xml and write_long_labels
+#drop them, since they change the tags.
+_INDEXES = weakref.WeakKeyDictionary()
+
+#zip archives opened by this process, as (process id, path): ZipFile.
+#Keyed by process id so forked workers open their own file handles.
+_ARCHIVES = {}
 
 def read_xml(file):
     '''
@@ -15,6 +34,60 @@ def read_xml(file):
     root = tree.getroot()
     return root
 
+def open_archive(archive_path):
+    '''
+    Returns this process's open ZipFile for the given archive.
+    '''
+    key = (os.getpid(), archive_path)
+    if key not in _ARCHIVES:
+        _ARCHIVES[key] = zipfile.ZipFile(archive_path)
+    return _ARCHIVES[key]
+
+def list_records(location):
+    '''
+    Lists the xml files in a folder or in a zip archive, without
+    extracting anything.
+    Input:
+        location: path to a folder or a .zip file
+    Returns:
+        list of records: a path for each file in a folder, or
+        (archive path, member name) for each file in an archive
+    '''
+    if zipfile.is_zipfile(location) and not os.path.isdir(location):
+        return [(location, info.filename) for info in open_archive(location).infolist()
+                if info.filename.endswith(".xml")]
+    return [os.path.join(location, file) for file in os.listdir(location)]
+
+def record_name(record):
+    '''
+    Returns the file name of a record from list_records.
+    '''
+    if isinstance(record, tuple):
+        return os.path.basename(record[1])
+    return os.path.basename(record)
+
+def open_record(record):
+    '''
+    Opens a record from list_records (or any file path) for reading
+    in binary, streaming it straight out of its archive if it has one.
+    '''
+    if isinstance(record, tuple):
+        return open_archive(record[0]).open(record[1])
+    return open(record, 'rb')
+
+def record_info(record):
+    '''
+    Returns (size, modification time, CRC-32) of a record from
+    list_records (or any file path). The CRC is only known without
+    reading the file for archive members; it is None otherwise.
+    '''
+    if isinstance(record, tuple):
+        info = open_archive(record[0]).getinfo(record[1])
+        return (info.file_size, time.mktime(info.date_time + (0, 0, -1)),
+                "%08x" % info.CRC)
+    stat = os.stat(record)
+    return (stat.st_size, stat.st_mtime, None)
+
 def print_xml(tree):
     '''
     Prints xml file tag and content to screen.
@@ -32,6 +105,7 @@ def clean_xml(tree):
     '''
     for line in tree.iter():
         line.tag = line.tag.split('}')[1]
+        _INDEXES.pop(line, None)
 
     return None
 
@@ -68,12 +142,77 @@ def write_long_labels(tree, prefix=None):
     else:
         if (prefix != "Return") and (prefix != "ReturnHeader") and (prefix != "ReturnData"):
             tree.tag = prefix + ":" + tree.tag
+    _INDEXES.pop(tree, None)
 
     for child in tree:
         write_long_labels(child, tree.tag)
 
     return None
 
+#write_long_labels does not prefix the children of these sections
+UNLABELED_SECTIONS = ("Return", "ReturnHeader", "ReturnData")
+
+#Numeric fields of the 990 summary (Part I), as column name: long label.
+#Money amounts are in whole dollars.
+NUMERIC_990_FIELDS = {'total_revenue': 'IRS990:CYTotalRevenueAmt',
+                      'total_expenses': 'IRS990:CYTotalExpensesAmt',
+                      'contributions_grants': 'IRS990:CYContributionsGrantsAmt',
+                      'total_assets': 'IRS990:TotalAssetsEOYAmt',
+                      'total_liabilities': 'IRS990:TotalLiabilitiesEOYAmt',
+                      'net_assets': 'IRS990:NetAssetsOrFundBalancesEOYAmt',
+                      'employees': 'IRS990:TotalEmployeeCnt',
+                      'volunteers': 'IRS990:TotalVolunteersCnt'}
+
+def compile_fields(field_names):
+    '''
+    Prepares a list of long labels (as written by write_long_labels)
+    for extract_fields.
+    Input: list of long labels, e.g., ['Filer:EIN', 'IRS990:WebsiteAddressTxt']
+    Returns: dictionary of long label: list of positions in field_names
+    '''
+    compiled = {}
+    for position, label in enumerate(field_names):
+        compiled.setdefault(label, []).append(position)
+    return compiled
+
+def extract_fields(file, compiled):
+    '''
+    Streams through an xml file once and returns the text of the
+    first element matching each compiled long label. Labels are
+    built from the path as the file is read, so the tree is never
+    cleaned or relabeled, and finished elements are cleared right
+    away. Stops reading once every field has been found.
+    Inputs:
+        file: path or binary file object of an IRS 990 xml
+        compiled: dictionary from compile_fields
+    Returns:
+        list of field values in the order given to compile_fields,
+        "" for fields missing from the form
+    '''
+    fields = [""] * sum(len(positions) for positions in compiled.values())
+    remaining = len(compiled)
+    found = set()
+    labels = []
+
+    for event, element in ET.iterparse(file, events=("start", "end")):
+        if event == "start":
+            tag = element.tag.rpartition('}')[2]
+            if labels and labels[-1] not in UNLABELED_SECTIONS:
+                tag = labels[-1] + ":" + tag
+            labels.append(tag)
+        else:
+            label = labels.pop()
+            if label in compiled and label not in found:
+                for position in compiled[label]:
+                    fields[position] = element.text
+                found.add(label)
+                remaining -= 1
+                if not remaining:
+                    break
+            element.clear()
+
+    return fields
+
 def get_xml_information(tree):
     '''
     Returns field names and contents to create a database from.
@@ -95,7 +234,50 @@ def get_xml_information(tree):
 
     return (names, fields)
 
-    
+def tree_index(tree):
+    '''
+    Returns the path index of a tree, built on first use by a single
+    walk and kept until the tree is gone (or relabeled by clean_xml or
+    write_long_labels). Every element is listed under its tag (the full
+    path, once write_long_labels has run) and under its leaf tag (the
+    part after the last ':'), in document order, so repeated elements
+    are all there.
+    Input:
+        tree: ElementTree object
+    Returns:
+        tuple of dictionaries (paths, leaves), each of tag: list of elements
+    '''
+    index = _INDEXES.get(tree)
+    if index is None:
+        paths = {}
+        leaves = {}
+        elements = tree.iter()
+        root = next(elements, None)
+        if root is not None:
+            elements = itertools.chain([weakref.proxy(root)], elements)
+        for element in elements:
+            paths.setdefault(element.tag, []).append(element)
+            leaf = element.tag.rpartition('}')[2].rpartition(':')[2]
+            leaves.setdefault(leaf, []).append(element)
+        index = (paths, leaves)
+        _INDEXES[tree] = index
+    return index
+
+def find_values(tree, tag):
+    '''
+    Returns the text of every element with the given tag, e.g.,
+    all of a filing's 'IRS990:ProgramServiceRevenueGrp:TotalRevenueColumnAmt'.
+    If no element has that full path, tag is looked up as a leaf tag
+    instead (e.g., 'TotalRevenueColumnAmt').
+    Input:
+        tree: ElementTree object
+        tag: full path or leaf tag
+    Returns:
+        list of texts, in document order
+    '''
+    paths, leaves = tree_index(tree)
+    return [element.text for element in paths.get(tag) or leaves.get(tag, [])]
+
 def search_tree(tree, tag, children=False):
     '''
     Recursively searches tree for given tag and
@@ -111,17 +293,15 @@ def search_tree(tree, tag, children=False):
         texts as values.
     '''
     g = {}
-    if tag == tree.tag:
-        if children:
-            for child in list(tree):
+    matches = tree_index(tree)[0].get(tag, [])
+    if children:
+        #children of every match, the first match winning
+        for match in matches:
+            for child in list(match):
                 g[child.tag] = g.get(child.tag, child.text)
-        else:
-            g[tree.tag] = g.get(tree.tag, tree.text)
-    else:
-        for i in list(tree):
-            r = search_tree(i, tag, children)
-            g = {**r, **g}
-            
+    elif matches:
+        g[tag] = matches[0].text
+
     return g
 
 def search_tags(tree, keyword):
@@ -130,67 +310,209 @@ def search_tags(tree, keyword):
     that given keyword. Allows user to search for tag that
     may correspond to what they are looking for. 
     Input:
-        tree: ElementTree object
+        tree: ElementTree object, or a catalog from
+        tag_catalog to search a whole corpus
         keyword: text to search for in tags
     Returns:
         list of tags with keyword included
     '''
-    tags = set()
-    if keyword.lower() in tree.tag.lower():
-        tags.add(tree.tag)
-    for child in list(tree):
-        result = search_tags(child, keyword)
-        if result:
-            tags.update(result)
-            
-    return list(tags)
+    tags = tree if isinstance(tree, dict) else tree_index(tree)[0]
+    keyword = keyword.lower()
+    return [tag for tag in tags if keyword in tag.lower()]
+
+def tag_catalog(trees):
+    '''
+    Builds a catalog of every tag used across a corpus, in one
+    pass, to search with search_tags or to see how often a
+    field is filled in.
+    Input:
+        trees: list (or iter_forms generator) of forms
+    Returns:
+        dictionary of tag: number of forms that have it,
+        most common first
+    '''
+    catalog = collections.Counter()
+    for tree in trees:
+        catalog.update(tree.keys() if isinstance(tree, dict) else tree_index(tree)[0].keys())
+    return dict(catalog.most_common())
     
 
-def filter_tree(trees, **kwargs):
+#Comparison operators of filter conditions
+COMPARISONS = {'==': operator.eq, '!=': operator.ne, '<': operator.lt,
+               '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+def normalize_condition(condition):
+    '''
+    Returns a filter condition in its tuple form. A condition is
+    one of:
+        (tag, op, value): op is one of COMPARISONS, 'in' or
+        'not in' (value is a list), or 'between' (value is
+        (low, high), inclusive). Numbers in value compare the
+        tag numerically, e.g., ('IRS990:CYTotalRevenueAmt', '>', 1000000)
+        ('and', [conditions]) / ('or', [conditions])
+        a dictionary of tag: value, meaning all of the tags have
+        those values (a list value means any of them)
+    '''
+    if isinstance(condition, dict):
+        return ('and', [(tag, 'in' if isinstance(value, (list, tuple, set)) else '==', value)
+                        for tag, value in condition.items()])
+    if condition[0] in ('and', 'or'):
+        return (condition[0], [normalize_condition(part) for part in condition[1]])
+    tag, op, value = condition
+    if op == '=':
+        op = '=='
+    if op not in COMPARISONS and op not in ('in', 'not in', 'between'):
+        raise ValueError("Unknown filter operator: " + str(op))
+    return (tag, op, value)
+
+def compare(text, op, value):
+    '''
+    Checks one (tag, op, value) condition against the text of a tag.
+    A form without the tag never matches, except for '!=' and 'not in'.
+    '''
+    if text is None:
+        return op in ('!=', 'not in')
+    values = value if op in ('in', 'not in', 'between') else [value]
+    if any(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+        try:
+            text = float(text)
+        except ValueError:
+            return False
+    if op == 'in':
+        return text in value
+    if op == 'not in':
+        return text not in value
+    if op == 'between':
+        return value[0] <= text <= value[1]
+    return COMPARISONS[op](text, value)
+
+def form_matches(form, condition):
+    '''
+    Checks whether a form (a tree, or a dictionary from iter_forms)
+    meets a normalized condition (see normalize_condition).
+    '''
+    if condition[0] == 'and':
+        return all(form_matches(form, part) for part in condition[1])
+    if condition[0] == 'or':
+        return any(form_matches(form, part) for part in condition[1])
+    tag, op, value = condition
+    return compare(form_value(form, tag), op, value)
+
+def filter_tree(trees, condition=None, **kwargs):
     '''
     Takes a list of trees and returns
-    those only which meet parameters.
+    those only which meet parameters, in a
+    single pass. Each form is checked once
+    and appears at most once. For forms
+    already in the database, see
+    database_functions.filter_filings.
     Inputs:
-        trees: a list of trees
-        **kwargs: a list of filters to
-        be applied to the trees
+        trees: a list (or iter_forms generator) of trees
+        condition: a filter condition (see
+        normalize_condition), e.g., ('and',
+        [('Filer:USAddress:StateAbbreviationCd', '==', 'IL'),
+         ('IRS990:CYTotalRevenueAmt', '>', 1000000)])
+        **kwargs: tag=value filters that must
+        all match as well
     Output:
         a list of filtered ElementTree objects
     '''
-    filtered_trees = []
+    conditions = [normalize_condition(kwargs)]
+    if condition:
+        conditions.append(normalize_condition(condition))
+    condition = ('and', conditions)
 
-    for tree in trees:
-        for key, value in kwargs.items():
-            check = search_tree(tree, key)
-            if check[key] == value:
-                filtered_trees.append(tree)
-                    
-    return filtered_trees
+    return [tree for tree in trees if form_matches(tree, condition)]
     
+def parse_form(record, functions=(), compiled=None):
+    '''
+    Reads one 990 for iter_forms: returns the tree with the functions
+    applied, or a dictionary of the compiled fields found in the form.
+    Returns None if the file can't be parsed.
+    '''
+    try:
+        with open_record(record) as file:
+            if compiled is not None:
+                values = extract_fields(file, compiled)
+                return {label: values[positions[0]] for label, positions in compiled.items()
+                        if values[positions[0]] != ""}
+            form = read_xml(file)
+    except ET.ParseError:
+        return None
+    for function in functions:
+        function(form)
+    return form
+
+def iter_forms(location, *functions, fields=None, processes=None, chunksize=32):
+    '''
+    Lazily reads the 990s in a folder or zip archive, one at a time, so
+    only the forms being worked on are held in memory. Yields each form
+    as an ElementTree object with the given functions applied, or, if
+    fields are given, as a dictionary of just those fields (much faster,
+    since the rest of the file is skipped). Either kind of form can be
+    passed to filter_tree, list_values, averages and find_highest_forms.
+    Files that can't be parsed are skipped.
+    Input:
+        location: system path to folder or zip archive of 990s
+        *functions: functions to apply to each tree, e.g., clean_xml,
+            write_long_labels
+        fields: list of long labels, e.g., ['IRS990:CYTotalRevenueAmt'].
+            If given, yields dictionaries of label: text for the labels
+            found in each form instead of trees.
+        processes: if given, number of processes parsing forms at once.
+            Functions must then be defined at the top level of a module.
+        chunksize: forms handed to a process at a time
+    Output:
+        generator of ElementTree objects or dictionaries, in file order
+    '''
+    compiled = compile_fields(fields) if fields else None
+    records = list_records(location)
+    parse = functools.partial(parse_form, functions=functions, compiled=compiled)
+    if not processes:
+        for record in records:
+            form = parse(record)
+            if form is not None:
+                yield form
+        return
+
+    #submit a window of records at a time, so finished forms can't
+    #pile up faster than they are consumed
+    window = processes * chunksize * 4
+    with mp.Pool(processes) as pool:
+        for start in range(0, len(records), window):
+            for form in pool.imap(parse, records[start:start + window], chunksize):
+                if form is not None:
+                    yield form
+
+def form_value(form, tag):
+    '''
+    Returns the text of a tag in a form from iter_forms (a tree or a
+    dictionary of fields). Returns None if the form doesn't have it.
+    '''
+    if isinstance(form, dict):
+        return form.get(tag)
+    matches = tree_index(form)[0].get(tag)
+    return matches[0].text if matches else None
+
 def aggregate(folder_path, *args):
     '''
-    Iterate through folder of 990s, applies
-    given functions to them, and returns a list.
+    Iterate through folder (or zip archive) of 990s,
+    applies given functions to them, and returns a list.
+    Loads every form into memory; use iter_forms
+    to go through them one at a time instead.
     Input:
         folder_path: system path to folder of 990s
         *args: functions to apply
     Output:
         list of ElementTree objects
     '''
-    forms = []
-    for file in os.listdir(folder_path):
-        location = folder_path + "/" + file
-        form = read_xml(location)
-        for function in args:
-            function(form)
-        forms.append(form)
-    return forms
+    return list(iter_forms(folder_path, *args))
 
 def averages(trees, tag, missingdata):
     '''
     Returns the average value for the selected tag.
     Input:
-        trees: list of ElementTree objects
+        trees: list (or iter_forms generator) of ElementTree objects
         tag: selected tag
         missingdata: Boolean. If true, assigns
         non-entered data a zero or '' value and sample
@@ -199,9 +521,11 @@ def averages(trees, tag, missingdata):
         on the form and prints out number of forms
         with values used.
     Output: int
+    For the financials table in the database, see
+    database_functions.financial_average.
     '''
-    values = list_values(trees, tag, True, missingdata)
-    return sum(values)/len(values)
+    values = np.array(list_values(trees, tag, True, missingdata), dtype=np.int64)
+    return values.mean()
     
 
 def plot_hist_values(values, missingdata=False):
@@ -219,9 +543,10 @@ def plot_hist_values(values, missingdata=False):
 def list_values(trees, tag, integers, missingdata):
     '''
     Creates a list of values for given tag
-    across a list of ElementTree objects
+    across a list of ElementTree objects,
+    in a single pass.
     Inputs:
-        trees: list of ElementTree objects
+        trees: list (or iter_forms generator) of ElementTree objects
         tag: a given tag
         integer: if values are integers, otherwise
         values are returned as strings
@@ -235,58 +560,104 @@ def list_values(trees, tag, integers, missingdata):
         list of values
     '''
     values = []
-    n = len(trees)
+    n = 0
     sample_size = 0
     for tree in trees:
-        val = search_tree(tree, tag)
+        n += 1
+        val = form_value(tree, tag)
         if missingdata:
-            if len(val) == 0:
+            if val is None:
                 (values.append(0) if integers else values.append(''))
             else:
-                (values.append(int(val[tag])) if integers
-                 else values.append(val[tag]))
+                (values.append(int(val)) if integers
+                 else values.append(val))
         else:
-            if len(val) != 0:
-                (values.append(int(val[tag])) if integers
-                 else values.append(val[tag]))
+            if val is not None:
+                (values.append(int(val)) if integers
+                 else values.append(val))
                 sample_size += 1
     if not missingdata:
         print("Out of {} given forms, {}, ({}%), had values".format(
             n, sample_size, (sample_size/n)*100))
     return values
 
+def top_forms(trees, tag, num_vals, filters=None, group_by=None):
+    '''
+    Returns the forms with the highest values of a tag,
+    in one pass over any iterable of forms (e.g., from
+    iter_forms). Keeps a heap of at most num_vals forms
+    (per group), so it runs in O(n log num_vals) time
+    and never holds the whole corpus.
+    Input:
+        trees: list (or iter_forms generator) of forms
+        tag: given tag, with integer values
+        num_vals: number of highest forms wanted (per group)
+        filters: dictionary of tag: value. Only forms whose
+        tag has that text are ranked; the value may instead
+        be a function of the text returning True or False.
+        group_by: if given, a tag to rank forms by separately
+        for each of its values, e.g.,
+        'Filer:USAddress:StateAbbreviationCd' for each state.
+    Returns:
+        list of forms, highest first; if group_by, a
+        dictionary of group value: list of forms
+    '''
+    filters = filters or {}
+    heaps = {}
+    for position, tree in enumerate(trees):
+        keep = True
+        for key, wanted in filters.items():
+            text = form_value(tree, key)
+            if not (wanted(text) if callable(wanted) else text == wanted):
+                keep = False
+                break
+        if not keep:
+            continue
+        value = form_value(tree, tag)
+        if value is None:
+            continue
+        group = form_value(tree, group_by) if group_by else None
+        heap = heaps.setdefault(group, [])
+        #the position breaks ties (earlier forms first), so forms
+        #themselves are never compared
+        item = (int(value), -position, tree)
+        if len(heap) < num_vals:
+            heapq.heappush(heap, item)
+        elif heap and item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    ranked = {group: [tree for _, _, tree in sorted(heap, reverse=True)]
+              for group, heap in heaps.items()}
+    if group_by:
+        return ranked
+    return ranked.get(None, [])
+
 def find_highest_forms(trees, tag, num_vals):
     '''
     Returns list of ElementTree objects in which
     given tag values are highest. Allows us to examine
     seemingly abnormally high values for a specific
-    organization.
+    organization. See top_forms to filter or group them.
+    For the financials table in the database, see
+    database_functions.highest_financials.
     Input:
-        trees: list of ElementTree objects
+        trees: list (or iter_forms generator) of ElementTree objects
         tag: given tag
         number_wanted: number of highest values you
         want returned
     '''
-    filtered_trees = {}
-    for tree in trees:
-        check = search_tree(tree, tag)
-        if len(check) != 0:
-            filtered_trees[tree] = filtered_trees.get(tree, int(check[tag]))
-
-    return sorted(filtered_trees, key=filtered_trees.get, reverse=True)[:num_vals]
+    return top_forms(trees, tag, num_vals)
 
 
 def get_quantiles(values, num_quantiles):
     '''
-    Returns list of tuples (quantile, value)
+    Returns list of tuples (quantile, value). For
+    the financials table in the database, see
+    database_functions.financial_quantiles.
     Input:
-        values: list of integers
+        values: list or array of integers
         num_quantiles: list of percentiles, e.g.,
         [0,.25, .5, .75, 1]
     '''
-    results = []
-    new_vals = np.array(values)
-    for val in num_quantiles:
-        amt = np.quantile(new_vals, val)
-        results.append((val, amt))
-    return results
\ No newline at end of file
+    amounts = np.quantile(np.asarray(values), num_quantiles)
+    return list(zip(num_quantiles, amounts))
\ No newline at end of file